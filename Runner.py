@@ -1,7 +1,20 @@
 import libtcodpy as libtcod
 import math
 import textwrap
-import shelve
+import os
+import json
+import marshal
+import struct
+import random
+import heapq
+import collections
+import multiprocessing
+
+try:  #import NumPy if available, to work out the whole map's colours at once
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
 
 #actual size of the window
 SCREEN_WIDTH = 80
@@ -31,6 +44,11 @@ ROOM_MAX_SIZE = 14
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 60
 
+#gateway spawning limits
+GATEWAY_SPAWN_CAP = 4  #spawns of one gateway alive at once
+LEVEL_SPAWN_BUDGET = 60  #monsters the gateways of a level may spawn in all
+LEVEL_ENEMY_CAP = 40  #gateways don't spawn while the level has this many enemies
+
 #magic constants
 HEAL_AMOUNT = 4
 LIGHTNING_RANGE = 5
@@ -46,6 +64,44 @@ FOV_ALGO = 0  #default FOV algorithm
 FOV_LIGHT_WALLS = True  #light walls or not
 TORCH_RADIUS = 6
 LIMIT_FPS = 10  #10 frames-per-second maximum
+BULK_PAINT_THRESHOLD = 256  #when more tiles than this changed, paint the whole map in one call
+PATH_GOAL_SLACK = 2  #a cached path is kept while its goal moved at most this many tiles
+WAKE_RADIUS = TORCH_RADIUS  #sleeping monsters wake when the player comes this close
+PATH_MAX_WAIT = 2  #turns to wait for whatever blocks a cached path before finding another one
+MAX_SHOOT_RANGE = 15  #the longest shot of any ranged monster, rays are worked out up to it
+ARROW_SPEED = 3  #tiles an arrow flies per tick
+NOISE_STEP = 2  #how many steps away the player's footsteps are heard
+NOISE_COMBAT = 5  #a fight
+NOISE_LIGHTNING = 8
+NOISE_FIREBALL = 12
+NOISE_BUDGET = 1000  #tiles all the sounds together spread over in a tick
+NOISE_MAX_SOUNDS = 32  #the oldest sound still spreading is dropped when there are more than this
+STEP_DIRECTIONS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+RNG_STREAMS = ['mapgen', 'spawn', 'ai', 'loot']  #one random number generator per subsystem
+LEVEL_RNG_STREAMS = ['mapgen', 'spawn', 'loot']  #reseeded for every new level
+headless = False  #set by init_headless(): no window, no consoles, no rendering
+pregenerate_levels = True  #make the next level in the background, see LevelPregenerator
+batch_monsters = numpy_available  #run the awake BasicMonsters as one batch, see MonsterSwarm
+con = None
+panel = None
+
+#rendering state, so that only what changed since the last frame gets drawn again
+fov_recompute = True
+frame_dirty = True  #something other than the map tiles changed (objects, messages, menus...)
+visible_cells = set()  #cell indexes currently in the player's FOV
+painted = bytearray(MAP_WIDTH * MAP_HEIGHT)  #background painted on each cell, see tile_color_code()
+drawn_cells = []  #where objects were drawn in the last frame
+mouse_cell = None
+
+#pathfinding state: one distance map from the player, shared by every monster chasing them
+player_dijkstra = None
+player_dijkstra_origin = None  #where the player was when it was last computed
+astar_path = None  #libtcod A* path object that every PathCache computes its paths with
+monster_sight = None  #what monsters see from where they stand, see SightCache
+path_computations = 0  #paths computed by PathCache.step()
+path_reuses = 0  #steps taken on an already computed path
+sight_traces = 0  #lines of sight traced by line_of_sight()
+sight_reuses = 0  #lines of sight a RangedAI still knew from an earlier turn
 
 #Character Progression
 LEVEL_UP_BASE = 400
@@ -57,34 +113,782 @@ color_light_wall = libtcod.Color(180, 60, 50)
 color_dark_ground = libtcod.Color(20, 20, 85)
 color_light_ground = libtcod.Color(250, 130, 50)
 color_target_ground = libtcod.light_blue #Color(255, 0, 0)
+#background colour for each code returned by tile_color_code(), 0 is never painted
+tile_colors = [None, color_dark_wall, color_dark_ground, color_light_wall, color_light_ground, color_target_ground]
+#translation tables from a colour code to each component of its colour, unpainted tiles are black
+palette_r = bytes(bytearray([0] + [color.r for color in tile_colors[1:]] + [0] * (256 - len(tile_colors))))
+palette_g = bytes(bytearray([0] + [color.g for color in tile_colors[1:]] + [0] * (256 - len(tile_colors))))
+palette_b = bytes(bytearray([0] + [color.b for color in tile_colors[1:]] + [0] * (256 - len(tile_colors))))
+
+
+class RandomStreams:
+    #independently seeded random number generators, one per subsystem, so that ie. monsters
+    #wandering around doesn't change how the next level is generated. python's generators are
+    #used instead of libtcod's, because their state can be saved along with the game
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+        self.seed = seed
+        self.streams = {}
+        for (i, name) in enumerate(RNG_STREAMS):
+            self.streams[name] = random.Random(seed * len(RNG_STREAMS) + i)
+
+    def start_level(self, level):
+        #reseed the level generation streams, so a level only depends on the seed and its number
+        for name in LEVEL_RNG_STREAMS:
+            self.streams[name].seed((self.seed * 1000 + level) * len(RNG_STREAMS) + RNG_STREAMS.index(name))
+
+    def get_int(self, stream, mi, ma):
+        #random integer between mi and ma (inclusive), like libtcod.random_get_int
+        return self.streams[stream].randint(mi, ma)
+
+
+class TileGrid:
+    #the map, stored as flat layers (one byte per tile) instead of one Tile object per cell.
+    #layers are indexed with x + y * width, so a whole layer can be read at once
+    def __init__(self, width, height, blocked=True, block_sight=None):
+        self.width = width
+        self.height = height
+        size = width * height
 
-
-class Tile:
-    #a tile of the map and its properties
-    def __init__(self, blocked, block_sight = None):
-        self.blocked = blocked
- 
-        #all tiles start untargeted
-        self.targeted = False
-        self.targeted_by = []
-
-        #all tiles start unexplored
-        self.explored = False
- 
         #by default, if a tile is blocked, it also blocks sight
         if block_sight is None: block_sight = blocked
-        self.block_sight = block_sight
+        self.blocked = bytearray([blocked]) * size
+        self.block_sight = bytearray([block_sight]) * size
+
+        #all tiles start unexplored and untargeted
+        self.explored = bytearray(size)
+        self.targeted = bytearray(size)
+
+        #shooters aiming at each targeted tile, only kept for tiles that are targeted
+        self.targeted_by = {}
+
+        #indexes of tiles that have to be drawn again
+        self.dirty = set()
+
+        #bumped whenever a tile may have started or stopped blocking sight
+        self.sight_version = 0
+
+    def __getitem__(self, x):
+        #map[x][y] still works, and gives a Tile view of the layers
+        return TileColumn(self, x)
+
+    def __len__(self):
+        return self.width
+
+    def index(self, x, y):
+        #where a tile is in the layers
+        return x + y * self.width
+
+    def carve(self, x, y):
+        #make a tile passable and see-through
+        i = self.index(x, y)
+        self.blocked[i] = 0
+        self.block_sight[i] = 0
+        self.sight_version += 1
+
+    def target(self, x, y, shooter):
+        i = self.index(x, y)
+        self.targeted[i] = 1
+        self.targeted_by.setdefault(i, []).append(shooter)
+        self.dirty.add(i)
+
+    def untarget(self, x, y, shooter):
+        i = self.index(x, y)
+        shooters = self.targeted_by.get(i)
+        if shooters is None: return
+        shooters.remove(shooter)
+        if len(shooters) == 0:
+            del self.targeted_by[i]
+            self.targeted[i] = 0
+            self.dirty.add(i)
+
+    def __getstate__(self):
+        #save the layers as a few flat byte strings
+        return {'width': self.width, 'height': self.height,
+                'blocked': bytes(self.blocked), 'block_sight': bytes(self.block_sight),
+                'explored': bytes(self.explored), 'targeted': bytes(self.targeted),
+                'targeted_by': self.targeted_by}
+
+    def __setstate__(self, state):
+        self.width = state['width']
+        self.height = state['height']
+        self.blocked = bytearray(state['blocked'])
+        self.block_sight = bytearray(state['block_sight'])
+        self.explored = bytearray(state['explored'])
+        self.targeted = bytearray(state['targeted'])
+        self.targeted_by = state['targeted_by']
+        self.sight_version = 0
+        self.dirty = set()
+
+
+class TileColumn:
+    #one column of a TileGrid, so that map[x][y] keeps working
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.x = x
+
+    def __getitem__(self, y):
+        return Tile(self.grid, self.x, y)
+
+    def __len__(self):
+        return self.grid.height
+
+
+class Tile(object):
+    #a view of a single tile of a TileGrid and its properties
+    def __init__(self, grid, x, y):
+        self.grid = grid
+        self.x = x
+        self.y = y
+        self.i = grid.index(x, y)
+
+    @property
+    def blocked(self):
+        return self.grid.blocked[self.i] == 1
+
+    @blocked.setter
+    def blocked(self, value):
+        self.grid.blocked[self.i] = 1 if value else 0
+
+    @property
+    def block_sight(self):
+        return self.grid.block_sight[self.i] == 1
+
+    @block_sight.setter
+    def block_sight(self, value):
+        self.grid.block_sight[self.i] = 1 if value else 0
+        self.grid.sight_version += 1
+
+    @property
+    def explored(self):
+        return self.grid.explored[self.i] == 1
+
+    @explored.setter
+    def explored(self, value):
+        self.grid.explored[self.i] = 1 if value else 0
+
+    @property
+    def targeted(self):
+        return self.grid.targeted[self.i] == 1
+
+    @property
+    def targeted_by(self):
+        return self.grid.targeted_by.get(self.i, [])
 
     def target(self, shooter):
-        self.targeted = True
-        self.targeted_by.append(shooter)
-        fov_recompute = True
+        self.grid.target(self.x, self.y, shooter)
 
     def untarget(self, shooter):
-        self.targeted_by.remove(shooter)
-        if len(self.targeted_by) == 0:
-            self.targeted = False
-            fov_recompute = True
+        self.grid.untarget(self.x, self.y, shooter)
+
+class OccupancyIndex:
+    #keeps track of which objects sit on which map cell, so looking up a cell
+    #doesn't have to walk the whole objects list
+    def __init__(self, width):
+        self.width = width
+        self.cells = {}  #cell index -> objects on that cell
+        self.blockers = {}  #cell index -> the blocking object on that cell
+
+    def add(self, obj):
+        i = obj.x + obj.y * self.width
+        self.cells.setdefault(i, []).append(obj)
+        if obj.blocks:
+            self.blockers[i] = obj
+
+    def remove(self, obj):
+        i = obj.x + obj.y * self.width
+        cell = self.cells.get(i)
+        if cell is not None and obj in cell:
+            cell.remove(obj)
+            if len(cell) == 0:
+                del self.cells[i]
+        if self.blockers.get(i) is obj:
+            del self.blockers[i]
+
+    def move(self, obj, x, y):
+        #move an object to a new cell, keeping the index up to date
+        self.remove(obj)
+        obj.x = x
+        obj.y = y
+        self.add(obj)
+
+    def update_blocking(self, obj):
+        #call after an object starts or stops blocking (ie. it died)
+        i = obj.x + obj.y * self.width
+        if obj.blocks:
+            self.blockers[i] = obj
+        elif self.blockers.get(i) is obj:
+            del self.blockers[i]
+
+    def blocking_at(self, x, y):
+        #returns the blocking object at (x, y), or None
+        return self.blockers.get(x + y * self.width)
+
+    def objects_at(self, x, y):
+        #returns all objects at (x, y)
+        return list(self.cells.get(x + y * self.width, ()))
+
+    def items_at(self, x, y):
+        #returns all items lying at (x, y)
+        return [obj for obj in self.cells.get(x + y * self.width, ()) if obj.item]
+
+    def fighter_at(self, x, y):
+        #returns the first object at (x, y) that can be attacked, or None
+        for obj in self.cells.get(x + y * self.width, ()):
+            if obj.fighter:
+                return obj
+        return None
+
+    @staticmethod
+    def build(objects, width):
+        #index a whole list of objects, ie. after loading a game
+        occupancy = OccupancyIndex(width)
+        for obj in objects:
+            occupancy.add(obj)
+        return occupancy
+
+
+class LevelStats:
+    #the numbers shown on the panel, kept up to date as things happen on the level
+    #instead of counting the whole map and objects list every frame
+    def __init__(self):
+        self.floor_tiles = 0
+        self.explored_tiles = 0  #explored floor tiles
+        self.enemies = 0
+        self.items = 0  #items lying on the floor
+
+    def count_tiles(self, map):
+        #count the floor tiles once the map is made, or loaded
+        self.floor_tiles = len(map.blocked) - sum(map.blocked)
+        #the explored walls don't count
+        self.explored_tiles = sum(1 for (explored, blocked) in zip(map.explored, map.blocked) if explored and not blocked)
+
+    def object_added(self, obj):
+        #an object was put on the level
+        if obj.fighter and obj is not player:
+            self.enemies += 1
+        if obj.item:
+            self.items += 1
+
+    def object_removed(self, obj):
+        #an object was taken off the level (ie. picked up)
+        if obj.fighter and obj is not player:
+            self.enemies -= 1
+        if obj.item:
+            self.items -= 1
+
+    @staticmethod
+    def build(map, objects):
+        #count everything from scratch, ie. after loading a game
+        stats = LevelStats()
+        stats.count_tiles(map)
+        for obj in objects:
+            stats.object_added(obj)
+        return stats
+
+
+class TurnScheduler:
+    #wakes each AI only on the ticks it actually does something, instead of calling every
+    #object's take_turn() every turn. a tick is one monster turn (one call of run_tick).
+    #AIs tell how many ticks away their next turn is with ticks_until_turn(); the ticks they
+    #skip in between only bump their counter, so that is caught up when they wake up
+    def __init__(self):
+        self.tick = 0  #the last tick that was run
+        self.running = False  #in the middle of run_tick
+        self.heap = []  #(wake tick, order, object) entries
+        #id of each scheduled object -> [last tick its counter accounts for, creation order, its heap entry].
+        #monsters act in creation order within a tick, and replaced heap entries are skipped when they come up
+        self.actors = {}
+        self.next_order = 0
+        self.swarm = MonsterSwarm() if batch_monsters else None  #runs the BasicMonsters instead of the heap
+
+    def add(self, obj):
+        #start scheduling an object's AI. one added during a tick gets that tick too, like an
+        #object appended to the list that monsters_take_turn used to walk
+        state = [self.tick - 1 if self.running else self.tick, self.next_order, None]
+        self.next_order += 1
+        self.actors[id(obj)] = state
+        self.schedule(obj, state)
+
+    def schedule(self, obj, state=None):
+        if state is None:
+            state = self.actors[id(obj)]
+        state[2] = None
+        swarm = self.swarm
+        if swarm is not None:
+            if swarm.remove(obj):
+                state[0] = self.tick  #the swarm counted every tick up to this one
+            if obj.ai.__class__ is BasicMonster:
+                swarm.add(obj, state[1])
+                return
+        if obj.ai is None:
+            return
+        ticks = obj.ai.ticks_until_turn()
+        if ticks is None:
+            return  #it will never act again
+        entry = (state[0] + ticks, state[1], obj)
+        state[2] = entry
+        heapq.heappush(self.heap, entry)
+
+    def sync(self, obj):
+        #catch up the counter of an object's AI with the ticks it skipped, up to the one
+        #before this tick; the tick itself is counted by take_turn()
+        state = self.actors.get(id(obj))
+        if state is None:
+            return
+        synced_to = self.tick - 1 if self.running else self.tick
+        if self.swarm is not None and self.swarm.sync(obj):
+            pass  #the swarm counts every tick itself
+        elif obj.ai is not None and state[2] is not None:
+            obj.ai.counter += synced_to - state[0]
+        state[0] = synced_to
+
+    def suspend(self, obj):
+        #stop waking an object's AI (ie. it fell asleep). its counter stays where it is until resume()
+        self.sync(obj)
+        state = self.actors.get(id(obj))
+        if state is not None:
+            state[2] = None
+        if self.swarm is not None:
+            self.swarm.remove(obj)
+
+    def resume(self, obj):
+        state = self.actors.get(id(obj))
+        if state is None:
+            self.add(obj)
+            return
+        state[0] = self.tick - 1 if self.running else self.tick
+        self.schedule(obj, state)
+
+    def sync_all(self):
+        #bring every counter up to date, ie. before saving the game
+        for state in list(self.actors.values()):
+            if state[2] is not None:
+                obj = state[2][2]
+                self.sync(obj)
+                self.schedule(obj, state)
+        if self.swarm is not None:
+            self.swarm.sync_all()
+
+    def run_tick(self):
+        tick = self.tick = self.tick + 1
+        self.running = True
+        heap = self.heap
+        actors = self.actors
+        while heap and heap[0][0] <= tick:
+            entry = heapq.heappop(heap)
+            obj = entry[2]
+            state = actors.get(id(obj))
+            if state is None or state[2] is not entry:
+                continue  #it was scheduled again since
+            ai = obj.ai
+            if ai is None:  #it died
+                del actors[id(obj)]
+                continue
+            ai.counter += tick - 1 - state[0]
+            ai.take_turn()
+            state[0] = tick
+            self.schedule(obj, state)
+        if self.swarm is not None:
+            self.swarm.run_tick()
+        self.running = False
+
+    @staticmethod
+    def build(objects):
+        #schedule every AI in a list of objects, ie. for a new level or a loaded game
+        scheduler = TurnScheduler()
+        for obj in objects:
+            if obj.ai:
+                scheduler.add(obj)
+        return scheduler
+
+
+class MonsterSwarm:
+    #runs every awake BasicMonster of the level as one batch with NumPy, instead of calling
+    #take_turn() on each. counters, speeds and positions are kept in arrays, and the ones that
+    #just wander around (nearly all of them on a crowded level) pick their steps together; the
+    #steps are checked against a grid of blocked tiles, and the first monster (in creation
+    #order, like the scheduler) to pick a free tile gets it. the few that see the player or are
+    #hunting for them still take their turn one by one, with BasicMonster.act()
+    def __init__(self):
+        self.members = []
+        self.ais = []  #the AI each member joined with, None once it left
+        self.orders = []  #the scheduler's creation order of each member
+        self.index = {}  #id of each member -> its position in members
+        self.stale = False  #members joined or left since the arrays were built
+        self.counter = numpy.zeros(0, int)
+        self.speed = numpy.zeros(0, int)
+        self.x = numpy.zeros(0, int)
+        self.y = numpy.zeros(0, int)
+        self.hunting = numpy.zeros(0, bool)  #has somewhere it last saw the player
+        self.sight = numpy.zeros(0, int)  #sight radius
+
+    def add(self, obj, order):
+        self.index[id(obj)] = len(self.members)
+        self.members.append(obj)
+        self.ais.append(obj.ai)
+        self.orders.append(order)
+        self.stale = True
+
+    def remove(self, obj):
+        #returns True if obj was a member. its AI gets its counter back
+        i = self.index.pop(id(obj), None)
+        if i is None:
+            return False
+        if i < len(self.counter):
+            self.ais[i].counter = int(self.counter[i])
+        self.ais[i] = None
+        self.stale = True
+        return True
+
+    def sync(self, obj):
+        #write a member's counter back to its AI, returns False if obj isn't a member
+        i = self.index.get(id(obj))
+        if i is None:
+            return False
+        if i < len(self.counter):
+            self.ais[i].counter = int(self.counter[i])
+        return True
+
+    def alert(self, obj):
+        #a member starts hunting without having acted, ie. it heard something
+        i = self.index.get(id(obj))
+        if i is not None and i < len(self.hunting):
+            self.hunting[i] = True
+
+    def sync_all(self):
+        for i in range(len(self.counter)):
+            if self.ais[i] is not None:
+                self.ais[i].counter = int(self.counter[i])
+
+    def build(self):
+        #drop the members that left and put the new ones in the arrays, in creation order
+        built = len(self.counter)
+        kept = sorted((i for i in range(len(self.members)) if self.ais[i] is not None), key=self.orders.__getitem__)
+        counter = [int(self.counter[i]) if i < built else self.ais[i].counter for i in kept]
+        self.members = [self.members[i] for i in kept]
+        self.ais = [self.ais[i] for i in kept]
+        self.orders = [self.orders[i] for i in kept]
+        self.index = dict((id(obj), i) for (i, obj) in enumerate(self.members))
+        self.counter = numpy.array(counter, int)
+        self.speed = numpy.array([ai.speed for ai in self.ais], int)
+        self.x = numpy.array([obj.x for obj in self.members], int)
+        self.y = numpy.array([obj.y for obj in self.members], int)
+        self.hunting = numpy.array([ai.last_seen is not None for ai in self.ais], bool)
+        self.sight = numpy.array([ai.sight_radius for ai in self.ais], int)
+        self.stale = False
+
+    def run_tick(self):
+        if self.stale:
+            self.build()
+        if not self.members:
+            return
+        (members, ais, x, y, hunting, sight) = (self.members, self.ais, self.x, self.y, self.hunting, self.sight)
+
+        #every clock ticks, the ones that reach their speed act (see BasicMonster.take_turn)
+        self.counter += 1
+        acting = numpy.flatnonzero(self.counter == self.speed)
+        self.counter[acting] = 0
+        if not len(acting):
+            return
+
+        #the ones that see the player, or that are hunting for the player, act one by one. only
+        #the few close enough to the player have to look
+        busy = hunting[acting]
+        near = ~busy & (numpy.maximum(abs(x[acting] - player.x), abs(y[acting] - player.y)) <= sight[acting])
+        for j in numpy.flatnonzero(near).tolist():
+            i = acting[j]
+            busy[j] = monster_sight.can_see(int(x[i]), int(y[i]), int(sight[i]), player.x, player.y)
+        for i in acting[busy].tolist():
+            obj = members[i]
+            if obj.ai is not ais[i]:
+                self.remove(obj)  #it died
+                continue
+            ais[i].act()
+            (x[i], y[i]) = (obj.x, obj.y)
+            hunting[i] = ais[i].last_seen is not None
+
+        #the others wander: a random step each, if the tile is free
+        wanderers = acting[~busy]
+        if not len(wanderers):
+            return
+        steps = numpy.random.RandomState(rng.streams['ai'].getrandbits(32))
+        new_x = x[wanderers] + steps.randint(-1, 2, len(wanderers))
+        new_y = y[wanderers] + steps.randint(-1, 2, len(wanderers))
+        inside = (new_x >= 0) & (new_x < MAP_WIDTH) & (new_y >= 0) & (new_y < MAP_HEIGHT)
+        cells = (new_x + new_y * MAP_WIDTH)[inside]
+        wanderers = wanderers[inside]
+
+        blocked = numpy.frombuffer(bytes(map.blocked), numpy.uint8).astype(bool)
+        blockers = occupancy.blockers
+        if blockers:
+            blocked[numpy.fromiter(blockers, int, len(blockers))] = True
+        free = ~blocked[cells]
+        (cells, first) = numpy.unique(cells[free], return_index=True)
+        movers = wanderers[free][first]
+
+        for (i, cell) in zip(movers.tolist(), cells.tolist()):
+            obj = members[i]
+            if obj.ai is not ais[i]:
+                self.remove(obj)
+                continue
+            occupancy.move(obj, cell % MAP_WIDTH, cell // MAP_WIDTH)
+        x[movers] = cells % MAP_WIDTH
+        y[movers] = cells // MAP_WIDTH
+
+
+class WakeZones:
+    #monsters placed in a room sleep until the player comes by: they're suspended in the turn
+    #scheduler, so they cost nothing per turn. a sleeper wakes when the player steps into its
+    #room or within WAKE_RADIUS of it, or when it gets hurt. sleepers are kept by room and by
+    #block of WAKE_RADIUS x WAKE_RADIUS tiles, so a player move only looks at the ones nearby
+    def __init__(self, width, height):
+        self.width = width
+        self.room_of = bytearray(width * height)  #room number of each tile, 0 outside of rooms
+        self.rooms = 0
+        self.by_room = {}  #room number -> sleepers in it
+        self.by_block = {}  #(x / WAKE_RADIUS, y / WAKE_RADIUS) -> sleepers in that block
+        self.asleep = {}  #id of each sleeper -> the sleeper
+
+    def add_room(self, room):
+        #number the tiles of a new room (the ones create_room carved) and put the monsters in it to sleep
+        self.rooms += 1
+        for y in range(room.y1 + 1, room.y2):
+            for x in range(room.x1 + 1, room.x2):
+                i = x + y * self.width
+                self.room_of[i] = self.rooms
+                for obj in occupancy.cells.get(i, ()):
+                    if obj.ai:
+                        self.sleep(obj)
+
+    def sleep(self, obj):
+        self.asleep[id(obj)] = obj
+        self.by_room.setdefault(self.room_of[obj.x + obj.y * self.width], []).append(obj)
+        self.by_block.setdefault((obj.x / WAKE_RADIUS, obj.y / WAKE_RADIUS), []).append(obj)
+        scheduler.suspend(obj)
+
+    def wake(self, obj):
+        if self.asleep.pop(id(obj), None) is None:
+            return  #it's awake already
+        self.by_room[self.room_of[obj.x + obj.y * self.width]].remove(obj)
+        self.by_block[(obj.x / WAKE_RADIUS, obj.y / WAKE_RADIUS)].remove(obj)
+        scheduler.resume(obj)
+
+    def is_asleep(self, obj):
+        return id(obj) in self.asleep
+
+    def player_moved(self, x, y):
+        #wake the sleepers in the room the player is in, and the ones within WAKE_RADIUS
+        if not self.asleep:
+            return
+        room = self.room_of[x + y * self.width]
+        if room:
+            for obj in list(self.by_room.get(room, ())):
+                self.wake(obj)
+        (block_x, block_y) = (x / WAKE_RADIUS, y / WAKE_RADIUS)
+        for by in range(block_y - 1, block_y + 2):
+            for bx in range(block_x - 1, block_x + 2):
+                for obj in list(self.by_block.get((bx, by), ())):
+                    if (obj.x - x) ** 2 + (obj.y - y) ** 2 <= WAKE_RADIUS ** 2:
+                        self.wake(obj)
+
+    @staticmethod
+    def build(width, height, room_of, sleepers):
+        #rebuild the zones from the room numbers and who is asleep, ie. for a loaded game.
+        #the scheduler has to be built first
+        zones = WakeZones(width, height)
+        zones.room_of = bytearray(room_of)
+        zones.rooms = max(zones.room_of or [0])
+        for obj in sleepers:
+            zones.sleep(obj)
+        return zones
+
+
+class Noise:
+    #a sound spreading from a tile, a step further every tile it's passed on to
+    def __init__(self, x, y, loudness):
+        (self.x, self.y) = (x, y)
+        self.loudness = loudness  #how many steps away it's heard
+        i = x + y * MAP_WIDTH
+        self.frontier = collections.deque([(i, loudness)])  #tiles it reached but didn't pass on yet, and how much further it carries
+        self.heard = set([i])  #tiles it reached
+
+
+class NoiseField:
+    #sounds spread with a flood fill over walkable tiles, as far as they're loud, and the
+    #monsters that hear one wake up and come to see where it came from. the fill goes on over
+    #several ticks: all the sounds together only spread over NOISE_BUDGET tiles per tick, and
+    #each tile is filled once per sound, so a loud one costs at most its own area
+    def __init__(self):
+        self.sounds = []  #oldest first
+
+    def emit(self, x, y, loudness):
+        for sound in self.sounds:
+            if sound.x == x and sound.y == y and sound.loudness >= loudness:
+                return  #one at least as loud is spreading from there already
+        self.sounds.append(Noise(x, y, loudness))
+        if len(self.sounds) > NOISE_MAX_SOUNDS:
+            del self.sounds[0]
+
+    def run_tick(self):
+        budget = NOISE_BUDGET
+        while self.sounds and budget > 0:
+            sound = self.sounds[0]
+            budget = self.spread(sound, budget)
+            if not sound.frontier:
+                del self.sounds[0]
+
+    def spread(self, sound, budget):
+        #returns the budget that's left
+        (frontier, heard) = (sound.frontier, sound.heard)
+        (blocked, blockers) = (map.blocked, occupancy.blockers)
+        source = sound.x + sound.y * MAP_WIDTH
+        while frontier and budget > 0:
+            (i, loudness) = frontier.popleft()
+            budget -= 1
+            obj = blockers.get(i)
+            if obj is not None and obj.ai is not None and i != source:  #whoever made it heard it already
+                self.alert(obj, sound)
+            if loudness == 0:
+                continue
+            (x, y) = (i % MAP_WIDTH, i / MAP_WIDTH)
+            for (dx, dy) in STEP_DIRECTIONS:
+                if 0 <= x + dx < MAP_WIDTH and 0 <= y + dy < MAP_HEIGHT:
+                    j = i + dx + dy * MAP_WIDTH
+                    if not blocked[j] and j not in heard:
+                        heard.add(j)
+                        frontier.append((j, loudness - 1))
+        return budget
+
+    def alert(self, obj, sound):
+        wake_zones.wake(obj)
+        if isinstance(obj.ai, BasicMonster):
+            obj.ai.last_seen = (sound.x, sound.y)
+            if scheduler.swarm is not None:
+                scheduler.swarm.alert(obj)
+
+
+class PathCache:
+    #an A* path that an AI keeps following for several turns, instead of computing a new one
+    #every turn. it's computed again when the goal moved more than PATH_GOAL_SLACK tiles from
+    #the one it was computed for, or when the next step on it stayed blocked for too long
+    def __init__(self):
+        self.goal = None  #the goal the path was computed for
+        self.cells = []  #the rest of the path, next step last
+        self.waited = 0  #turns the next step has been blocked
+
+    def clear(self):
+        self.goal = None
+        self.cells = []
+        self.waited = 0
+
+    def step(self, obj, goal_x, goal_y):
+        #move obj one step along a path to the goal, returns False if there is no path
+        global path_computations, path_reuses
+        goal = self.goal
+        if self.cells and max(abs(goal_x - goal[0]), abs(goal_y - goal[1])) <= PATH_GOAL_SLACK:
+            path_reuses += 1
+        else:
+            self.clear()
+            path_computations += 1
+            if not libtcod.path_compute(astar_path, obj.x, obj.y, goal_x, goal_y):
+                return False
+            self.goal = (goal_x, goal_y)
+            self.cells = [libtcod.path_get(astar_path, i) for i in range(libtcod.path_size(astar_path) - 1, -1, -1)]
+            if not self.cells:
+                return False
+
+        (x, y) = self.cells[-1]
+        if max(abs(x - obj.x), abs(y - obj.y)) != 1:
+            self.clear()  #obj got moved off the path, find another one next turn
+            return True
+        if is_blocked(x, y):
+            #someone is in the way. A* goes around walls only, so a new path would most likely be
+            #the same one: wait for them to move on, and only look for another path if they don't
+            self.waited += 1
+            if self.waited > PATH_MAX_WAIT:
+                self.clear()
+            return True
+        self.waited = 0
+        self.cells.pop()
+        occupancy.move(obj, x, y)
+        return True
+
+def path_cache_hit_rate():
+    #fraction of the steps on a PathCache path that didn't need a new path
+    if path_computations + path_reuses == 0:
+        return 0.0
+    return float(path_reuses) / (path_computations + path_reuses)
+
+
+class SightCache:
+    #what monsters see from where they stand, instead of "if you can see it, it can see you".
+    #the FOV from a tile with a sight radius is computed once, on a libtcod map of its own so
+    #the player's FOV is left alone, and kept as a set of tile indexes for the rest of the
+    #level. they're all dropped when a tile starts or stops blocking sight
+    def __init__(self):
+        self.fov_map = None
+        self.grid = None  #the map the FOVs were computed on
+        self.version = None  #its sight_version then
+        self.views = {}  #(x, y, radius) -> indexes of the tiles seen from (x, y)
+
+    def view(self, x, y, radius):
+        if map is not self.grid or map.sight_version != self.version:
+            if self.fov_map is None:
+                self.fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+            fill_fov_map(self.fov_map)
+            self.grid = map
+            self.version = map.sight_version
+            self.views = {}
+
+        key = (x, y, radius)
+        view = self.views.get(key)
+        if view is None:
+            libtcod.map_compute_fov(self.fov_map, x, y, radius, FOV_LIGHT_WALLS, FOV_ALGO)
+            (x1, x2) = (max(0, x - radius), min(MAP_WIDTH, x + radius + 1))
+            (y1, y2) = (max(0, y - radius), min(MAP_HEIGHT, y + radius + 1))
+            view = self.views[key] = frozenset(cell_x + cell_y * MAP_WIDTH for cell_y in range(y1, y2) for cell_x in range(x1, x2)
+                                               if libtcod.map_is_in_fov(self.fov_map, cell_x, cell_y))
+        return view
+
+    def can_see(self, x, y, radius, target_x, target_y):
+        #True if a monster at (x, y) that sees radius tiles far can see the target tile
+        if max(abs(target_x - x), abs(target_y - y)) > radius:
+            return False  #out of its sight whatever is in the way, no need to look
+        return target_x + target_y * MAP_WIDTH in self.view(x, y, radius)
+
+
+class LevelPregenerator:
+    #makes the next level in a worker process while the current one is being played, so
+    #taking the stairs doesn't have to wait for it. a process is used (not a thread) because
+    #making a level replaces the module's globals, which the game is still using
+    def __init__(self):
+        self.pool = None
+        self.pending = None  #the level being made
+        self.key = None  #(seed, level number) of the pending level
+
+    def start(self, seed, level):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(1)
+        self.key = (seed, level)
+        self.pending = self.pool.apply_async(generate_level, (seed, level))
+
+    def take(self, seed, level):
+        #returns the level made in the background (waiting for it if it isn't done yet),
+        #or None if it wasn't started, failed, or was made for another seed or level
+        (pending, key) = (self.pending, self.key)
+        self.pending = None
+        self.key = None
+        if pending is None or key != (seed, level):
+            return None
+        try:
+            return pending.get()
+        except Exception:
+            return None
+
+level_pregenerator = LevelPregenerator()
+
 
 class Rect:
     #a rectangle on the map. used to characterize a room.
@@ -138,20 +942,17 @@ class Object:
     def move(self, dx, dy):
         #move by the given amount, if the destination is not blocked
         if not is_blocked(self.x + dx, self.y + dy):
-            self.x += dx
-            self.y += dy
+            occupancy.move(self, self.x + dx, self.y + dy)
  
     def draw(self):
-        #only show if it's visible to the player
-        if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or (self.always_visible and map[self.x][self.y].explored)):
+        #only show if it's visible to the player, returns True if it was drawn
+        if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or (self.always_visible and map.explored[self.x + self.y * MAP_WIDTH])):
             #set the color and then draw the character that represents this object at its position
             libtcod.console_set_default_foreground(con, self.color)
             libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
+            return True
+        return False
  
-    def clear(self):
-        #erase the character that represents this object
-        libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
-
     def move_towards(self, target_x, target_y):
         #vector from this object to the target, and distance
         dx = target_x - self.x
@@ -164,6 +965,28 @@ class Object:
         dy = int(round(dy/distance))
         self.move(dx, dy)
 
+    def step_towards_player(self):
+        #take one step downhill on the shared distance map from the player, which goes around
+        #walls. falls back to a straight line when the player can't be reached at all
+        here = player_distance(self.x, self.y)
+        if here < 0:
+            self.move_towards(player.x, player.y)
+            return
+        best = None
+        for (dx, dy) in STEP_DIRECTIONS:
+            (x, y) = (self.x + dx, self.y + dy)
+            if not (0 <= x < MAP_WIDTH and 0 <= y < MAP_HEIGHT):
+                continue
+            distance = player_distance(x, y)
+            if distance < 0 or distance >= here or is_blocked(x, y):
+                continue
+            #of the steps that get as close, prefer the one most in line with the player
+            key = (distance, (player.x - x) ** 2 + (player.y - y) ** 2)
+            if best is None or key < best[0]:
+                best = (key, dx, dy)
+        if best is not None:
+            self.move(best[1], best[2])
+
     def distance_to(self, other):
         #return the distance to another object:
         dx = other.x - self.x
@@ -197,26 +1020,41 @@ class Fighter:
         self.base_power = power
         self.xp = xp
         self.death_function = death_function
+        self.equipped = {}  #slot -> the equipment worn in it
+        self.bonuses = None  #(max hp, defense, power) bonuses of the equipped items, see equipment_bonuses()
 
     @property
-    def max_hp(self):  #return actual max_hp, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_max_hp + bonus
+    def max_hp(self):  #return actual max_hp, with the bonuses from all equipped items
+        return self.base_max_hp + self.equipment_bonuses()[0]
 
     @property
-    def defense(self):  #return actual defense, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.defense_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_defense + bonus
+    def defense(self):  #return actual defense, with the bonuses from all equipped items
+        return self.base_defense + self.equipment_bonuses()[1]
 
     @property
-    def power(self):  #return actual power, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.power_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_power + bonus
+    def power(self):  #return actual power, with the bonuses from all equipped items
+        return self.base_power + self.equipment_bonuses()[2]
+
+    def equipment_bonuses(self):
+        #the bonuses are summed up once, and only again after the equipment changed. the base
+        #stats aren't in there, so level-up rewards don't have to tell
+        bonuses = self.bonuses
+        if bonuses is None:
+            equipped = self.equipped.values()
+            bonuses = self.bonuses = (sum(equipment.max_hp_bonus for equipment in equipped),
+                                      sum(equipment.defense_bonus for equipment in equipped),
+                                      sum(equipment.power_bonus for equipment in equipped))
+        return bonuses
+
+    def equipment_changed(self):
+        #call after something was equipped or dequipped
+        self.bonuses = None
 
     
 
     def take_damage(self, damage):
         #apply damage if possible
+        wake_zones.wake(self.owner)
         if damage > 0:
             self.hp -= damage
             if self.hp <= 0:
@@ -231,6 +1069,7 @@ class Fighter:
         #a simple formula for attack damage
         damage = self.power - target.fighter.defense
 
+        noise.emit(self.owner.x, self.owner.y, NOISE_COMBAT)
         if damage > 0:
             #make the target take some damage
             message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.', libtcod.light_red)
@@ -245,9 +1084,24 @@ class Fighter:
             self.hp = self.max_hp
 
 class BasicMonster:
-    def __init__(self, speed=3):
+    def __init__(self, speed=3, sight_radius=TORCH_RADIUS):
         self.speed = speed
         self.counter = 0
+        self.sight_radius = sight_radius  #how far it sees from where it stands
+        self.last_seen = None  #where it last saw (or heard) the player, it goes there after losing sight of them
+        self.path = PathCache()
+
+    def ticks_until_turn(self):
+        #the monster acts when its counter reaches its speed
+        if self.counter >= self.speed:
+            return None  #it never will
+        return self.speed - self.counter
+
+    def reset(self):
+        #start over, ie. when a gateway spawns it again
+        self.counter = 0
+        self.last_seen = None
+        self.path.clear()
 
     #AI for a basic monster.
     def take_turn(self):
@@ -257,64 +1111,114 @@ class BasicMonster:
             self.counter = 0
         else:
             return
+        self.act()
 
-        #a basic monster takes its turn. If you can see it, it can see you
+    def act(self):
+        #a basic monster takes its turn. it goes for the player if it can see them
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if stumbles(monster):
+            return
+        if monster_sight.can_see(monster.x, monster.y, self.sight_radius, player.x, player.y):
+            self.last_seen = (player.x, player.y)
 
             #move towards player if far away
-            if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+            if max(abs(player.x - monster.x), abs(player.y - monster.y)) >= 2:
+                monster.step_towards_player()
 
             #close enough, attack! (if the player is still alive.)
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
+        elif self.last_seen is not None:
+            #lost sight of the player, go look where they were last seen
+            (x, y) = self.last_seen
+            if max(abs(x - monster.x), abs(y - monster.y)) <= 1 or not self.path.step(monster, x, y):
+                self.last_seen = None
+                self.path.clear()
         else:
-            x = libtcod.random_get_int(0, -1, 1)
-            y = libtcod.random_get_int(0, -1, 1)
+            x = rng.get_int('ai', -1, 1)
+            y = rng.get_int('ai', -1, 1)
             monster.move(x, y)
 
 
-class ConfusedMonster:
-    def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
-        self.old_ai = old_ai
-        self.num_turns = num_turns
-        self.speed = CONFUSE_DEFAULT_SPEED
-        if self.old_ai.speed:
-            self.speed = self.old_ai.speed
-        self.counter = 0
-        if self.old_ai.counter:
-            self.counter = self.old_ai.counter
-            
-    #AI for confused monster.
-    def take_turn(self):
-        if self.num_turns > 0:  #Still confused...
-            #a confused monster's interal clock ticks
-            self.counter += 1
-            if self.counter == self.speed:
-                self.counter = 0
-                self.num_turns -= 1
-            else:
-                return
-
-            #move in a random direction
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
-        else:  #restore the previous AI (this one will be deleted cuz no longer referenced)
-            if self.old_ai.counter:
-                self.old_ai.counter = self.counter
-            self.owner.ai = self.old_ai
-            message ('The ' + self.owner.name + ' is no longer disoriented.', libtcod.lighter_yellow)
+class StatusEffects:
+    #timed effects on the player or a monster, like confusion. an effect doesn't replace the AI,
+    #the AIs check for it where it changes what they do (see stumbles()). different kinds stack, and
+    #one applied again lasts until the later of the two expiries. the expiries are kept in a heap
+    #keyed by tick, so a tick only looks at the effects that actually ran out
+    words = {'confused': 'disoriented'}  #for the message when an effect wears off
+
+    def __init__(self):
+        self.tick = 0  #its own clock, the scheduler's starts over on every level
+        self.heap = []  #(expiry tick, order, object, kind), replaced entries are skipped when they come up
+        self.next_order = 0
+        self.active = {}  #id of an affected object -> {kind: expiry tick}
+
+    def apply(self, obj, kind, ticks):
+        #the effect lasts through the next ticks ticks
+        effects = self.active.setdefault(id(obj), {})
+        expiry = max(self.tick + ticks, effects.get(kind, 0))
+        effects[kind] = expiry
+        heapq.heappush(self.heap, (expiry, self.next_order, obj, kind))
+        self.next_order += 1
+
+    def has(self, obj, kind):
+        effects = self.active.get(id(obj))
+        return effects is not None and kind in effects
+
+    def clear(self, obj):
+        #end every effect on an object, ie. when a gateway takes its spawn back
+        self.active.pop(id(obj), None)
+
+    def keep_only(self, obj):
+        #drop the effects on everything but obj (the player), when the level changes
+        effects = self.active.get(id(obj))
+        self.active = {id(obj): effects} if effects else {}
+        self.heap = [entry for entry in self.heap if entry[2] is obj]
+        heapq.heapify(self.heap)
+
+    def entries(self):
+        #the effects still active, in the order they run out
+        return [entry for entry in sorted(self.heap) if self.active.get(id(entry[2]), {}).get(entry[3]) == entry[0]]
+
+    def run_tick(self):
+        tick = self.tick = self.tick + 1
+        heap = self.heap
+        while heap and heap[0][0] < tick:
+            (expiry, order, obj, kind) = heapq.heappop(heap)
+            effects = self.active.get(id(obj))
+            if effects is None or effects.get(kind) != expiry:
+                continue  #it was cleared, or applied again since
+            del effects[kind]
+            if not effects:
+                del self.active[id(obj)]
+            if obj is player:
+                message('You are no longer ' + self.words[kind] + '.', libtcod.lighter_yellow)
+            elif obj.fighter is not None:
+                message('The ' + obj.name + ' is no longer ' + self.words[kind] + '.', libtcod.lighter_yellow)
+
+def stumbles(obj):
+    #a confused monster moves in a random direction instead of taking its turn. True if it did
+    if not status.active or not status.has(obj, 'confused'):
+        return False
+    obj.move(rng.get_int('ai', -1, 1), rng.get_int('ai', -1, 1))
+    return True
 
 
 class GatewayAI:
-    def __init__(self, obj, speed=8, spawn_range=15):
+    def __init__(self, obj, speed=8, spawn_range=15, max_spawns=GATEWAY_SPAWN_CAP):
         self.obj = obj
         self.speed = speed
         self.counter = 0
         self.spawn_range = spawn_range
+        self.max_spawns = max_spawns  #how many of its spawns may be alive at once
+        self.spawned = []  #its spawns. the dead ones are off the level, and get spawned again
+
+    def ticks_until_turn(self):
+        return 1  #its clock only ticks while the player is in range, so check every tick
 
     #AI for a basic monster.
     def take_turn(self):
+        global spawn_budget
         gateway = self.owner
         if gateway.distance_to(player) <= self.spawn_range:
             #a basic monster's interal clock ticks
@@ -323,35 +1227,104 @@ class GatewayAI:
                 self.counter = 0
             else:
                 return
+            if stumbles(gateway):
+                return
 
-            x = 0
-            y = 0
-            attempt = 0
-            while True:
-                x = gateway.x + libtcod.random_get_int(0, -1, 1)
-                y = gateway.y + libtcod.random_get_int(0, -1, 1)
-                if not is_blocked(x, y):
-                    break
-                else:
-                    attempt += 1
-                    if attempt == 12:
-                        self.counter = self.speed - 2
-                        return
+            #hold back while enough of its spawns are around, or the level has enough enemies
+            alive = 0
+            dead = None
+            for spawn in self.spawned:
+                if spawn.fighter.hp > 0:
+                    alive += 1
+                elif dead is None:
+                    dead = spawn
+            if alive >= self.max_spawns or spawn_budget <= 0 or level_stats.enemies >= LEVEL_ENEMY_CAP:
+                return
 
-            ObjectFactory.create_object(self.obj, x, y)
+            #spawn on a random free tile next to the gateway, or try again soon if there's none
+            free = [(gateway.x + dx, gateway.y + dy) for (dx, dy) in STEP_DIRECTIONS
+                    if not is_blocked(gateway.x + dx, gateway.y + dy)]
+            if not free:
+                self.counter = self.speed - 2
+                return
+            (x, y) = free[rng.get_int('spawn', 0, len(free) - 1)]
+            spawn_budget -= 1
+
+            if dead is not None:
+                #bring back a dead spawn instead of making a new one
+                dead.fighter.hp = dead.fighter.max_hp
+                dead.ai.reset()
+                (dead.x, dead.y) = (x, y)
+                ObjectFactory.append_front(dead)
+            else:
+                ObjectFactory.create_object(self.obj, x, y)
+                spawn = objects[-1]  #monsters are appended to the list
+                spawn.fighter.death_function = spawn_death
+                self.spawned.append(spawn)
+
+
+def sweep_offsets(dx, dy):
+    #the three tiles right in front of an attacker facing (dx, dy), across that direction
+    (x, y) = (-dx, -dy)
+    if dx == 0:
+        return ((x - 1, y), (x, y), (x + 1, y))
+    if dy == 0:
+        return ((x, y - 1), (x, y), (x, y + 1))
+    return ((x + dx, y), (x, y), (x, y + dy))
+
+#attack shapes for AttackTelegraph: for each direction, the offsets of the tiles it hits from
+#where it's aimed. they're worked out once here, so aiming an attack is only a lookup. the
+#directions are the ones Object.get_direction() returns, which point from the target back to
+#the attacker. 'throw' is aimed at the target instead, (1, 0) across and (0, 1) up and down
+ATTACK_SHAPES = {
+    'sweep': dict((direction, sweep_offsets(*direction)) for direction in STEP_DIRECTIONS),
+    'slam': dict(((dx, dy), tuple((-dx * i, -dy * i) for i in range(1, 4))) for (dx, dy) in STEP_DIRECTIONS),
+    'throw': {(1, 0): ((-1, 0), (0, 0), (1, 0)), (0, 1): ((0, -1), (0, 0), (0, 1))},
+}
+
+
+class AttackTelegraph:
+    #a telegraphed attack, for any AI: aim() marks the tiles of a shape on the map for one
+    #turn, and resolve() clears them and tells who is still standing on one. the tiles are
+    #kept as a set of indexes, so checking a target is one lookup however big the shape is
+    def __init__(self):
+        self.cells = set()
+
+    def aim(self, attacker, shape, direction, x, y):
+        for (dx, dy) in ATTACK_SHAPES[shape][direction]:
+            (cell_x, cell_y) = (x + dx, y + dy)
+            i = cell_x + cell_y * MAP_WIDTH
+            if 0 <= cell_x < MAP_WIDTH and 0 <= cell_y < MAP_HEIGHT and i not in self.cells:
+                self.cells.add(i)
+                map.target(cell_x, cell_y, attacker)
+
+    def resolve(self, attacker, targets):
+        #returns the targets that are on an aimed tile
+        cells = self.cells
+        hit = [target for target in targets if target.x + target.y * MAP_WIDTH in cells]
+        for i in sorted(cells):
+            map.untarget(i % MAP_WIDTH, i / MAP_WIDTH, attacker)
+        self.cells = set()
+        return hit
+
+    def points(self):
+        return [(i % MAP_WIDTH, i / MAP_WIDTH) for i in sorted(self.cells)]
 
 
 class GoblinKingAI:
-    def __init__(self, speed=4, sub_ai=None):
+    def __init__(self, speed=4, sub_ai=None, sight_radius=TORCH_RADIUS):
         self.speed = speed
         self.counter = 0
+        self.sight_radius = sight_radius  #how far he sees from where he stands
         self.enraged = False
         self.attack_type = 0
-        self.target_tiles = []
-        self.target_coordinates = []
+        self.telegraph = AttackTelegraph()
 
         self.sub_ai = sub_ai
 
+    def ticks_until_turn(self):
+        return 1  #its attacks and sub AI go on every tick
+
     def take_turn(self):
         #secondary AI takes a turn
         if self.sub_ai:
@@ -373,10 +1346,12 @@ class GoblinKingAI:
 
         #The goblin king takes his turn. He moves and attacks.
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if stumbles(monster):
+            return
+        if monster_sight.can_see(monster.x, monster.y, self.sight_radius, player.x, player.y):
             #move towards player if far away
-            if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+            if max(abs(player.x - monster.x), abs(player.y - monster.y)) >= 2:
+                monster.step_towards_player()
             #attack
             self.attack()
 
@@ -384,7 +1359,7 @@ class GoblinKingAI:
         monster = self.owner
 
         if self.attack_type == 0:
-            self.attack_type = libtcod.random_get_int(0, 1, 4)
+            self.attack_type = rng.get_int('ai', 1, 4)
 
             #BASIC ATTACK
             if self.attack_type == 1:
@@ -396,119 +1371,209 @@ class GoblinKingAI:
 
             #LINE/ANGLE IN FRONT ATTACK
             elif self.attack_type == 2:
-                (new_x, new_y) = monster.get_direction(player)
-                x = monster.x - new_x
-                y = monster.y - new_y
-
-                if new_x == 0:
-                    self.target_tiles.append(map[x-1][y])
-                    self.target_tiles.append(map[x][y])
-                    self.target_tiles.append(map[x+1][y])
-                    self.target_coordinates.append((x-1, y))
-                    self.target_coordinates.append((x, y))
-                    self.target_coordinates.append((x+1, y))
-                elif new_y == 0:
-                    self.target_tiles.append(map[x][y-1])
-                    self.target_tiles.append(map[x][y])
-                    self.target_tiles.append(map[x][y+1])
-                    self.target_coordinates.append((x, y-1))
-                    self.target_coordinates.append((x, y))
-                    self.target_coordinates.append((x, y+1))
-                else:
-                    if new_x > 0:
-                        if new_y > 0:
-                            self.target_tiles.append(map[x+1][y])
-                            self.target_tiles.append(map[x][y])
-                            self.target_tiles.append(map[x][y+1])
-                            self.target_coordinates.append((x+1, y))
-                            self.target_coordinates.append((x, y))
-                            self.target_coordinates.append((x, y+1))
-                        else:
-                            self.target_tiles.append(map[x+1][y])
-                            self.target_tiles.append(map[x][y])
-                            self.target_tiles.append(map[x][y-1])
-                            self.target_coordinates.append((x+1, y))
-                            self.target_coordinates.append((x, y))
-                            self.target_coordinates.append((x, y-1))
-                    else:
-                        if new_y > 0:
-                            self.target_tiles.append(map[x-1][y])
-                            self.target_tiles.append(map[x][y])
-                            self.target_tiles.append(map[x][y+1])
-                            self.target_coordinates.append((x-1, y))
-                            self.target_coordinates.append((x, y))
-                            self.target_coordinates.append((x, y+1))
-                        else:
-                            self.target_tiles.append(map[x-1][y])
-                            self.target_tiles.append(map[x][y])
-                            self.target_tiles.append(map[x][y-1])
-                            self.target_coordinates.append((x-1, y))
-                            self.target_coordinates.append((x, y))
-                            self.target_coordinates.append((x, y-1))
-
-                for tile in self.target_tiles:
-                    tile.target(monster)
+                self.telegraph.aim(monster, 'sweep', monster.get_direction(player), monster.x, monster.y)
                 message('The ' + monster.name + ' prepares to swing his hammer!', color_target_ground)
 
             #STRAIGHT LINE TOWARD PLAYER ATTACK
             elif self.attack_type == 3:
-                (x, y) = monster.get_direction(player)
-                for i in range(1, 4):
-                    self.target_tiles.append(map[monster.x - x * i][monster.y - y * i])
-
-                for tile in self.target_tiles:
-                    tile.target(monster)
+                self.telegraph.aim(monster, 'slam', monster.get_direction(player), monster.x, monster.y)
                 message('The ' + monster.name + ' lifts his hammer over his head!', color_target_ground)
 
             #LINE OVERTOP PLAYER
             elif self.attack_type == 4:
                 if monster.distance_to(player) <= 4:
-                    x = player.x
-                    y = player.y
-
-                    if libtcod.random_get_int(0, 0, 1) == 1:
-                        self.target_tiles.append(map[x-1][y])
-                        self.target_tiles.append(map[x][y])
-                        self.target_tiles.append(map[x+1][y])
-                        self.target_coordinates.append((x-1, y))
-                        self.target_coordinates.append((x, y))
-                        self.target_coordinates.append((x+1, y))
+                    if rng.get_int('ai', 0, 1) == 1:
+                        direction = (1, 0)
                     else:
-                        self.target_tiles.append(map[x][y-1])
-                        self.target_tiles.append(map[x][y])
-                        self.target_tiles.append(map[x][y+1])
-                        self.target_coordinates.append((x, y-1))
-                        self.target_coordinates.append((x, y))
-                        self.target_coordinates.append((x, y+1))
-
-                    for tile in self.target_tiles:
-                        tile.target(monster)
+                        direction = (0, 1)
+                    self.telegraph.aim(monster, 'throw', direction, player.x, player.y)
                     message('The ' + monster.name + ' throws his hammer into the air!', color_target_ground)
 
     def continue_attack(self):
         if self.attack_type > 1:
-            flag = False
             monster = self.owner
 
-            #Untarget tiles
-            for tile in self.target_tiles:
-                tile.untarget(monster)
+            #untarget the tiles, and apply damage to the player if they're still on one of them
+            if self.telegraph.resolve(monster, [player]):
+                monster.fighter.attack(player)
+            else:
+                message('The ' + monster.name + ' attacks, but he missed!', libtcod.light_blue)
 
-            for i in range(len(self.target_tiles)):
-                self.target_tiles.pop()
+        self.attack_type = 0
 
-            #Apply damage to player if they're in any of the targeted spaces
-            for (x, y) in self.target_coordinates:
-                if player.x == x and player.y == y:
-                        monster.fighter.attack(player)
-                        flag = True
-            for i in range(len(self.target_coordinates)):
-                self.target_coordinates.pop()
 
-            if not flag:
-                message('The ' + monster.name + ' attacks, but he missed!', libtcod.light_blue)
+def ray_offsets(dx, dy):
+    #the tiles of a Bresenham line from (0, 0) to (dx, dy), not counting (0, 0)
+    (step_x, step_y) = (1 if dx > 0 else -1, 1 if dy > 0 else -1)
+    (long, short) = (abs(dx), abs(dy))
+    if long < short:
+        (long, short) = (short, long)
+    (x, y) = (0, 0)
+    error = long / 2
+    ray = []
+    for i in range(long):
+        error -= short
+        if abs(dx) >= abs(dy):
+            x += step_x
+            if error < 0:
+                y += step_y
+        else:
+            y += step_y
+            if error < 0:
+                x += step_x
+        if error < 0:
+            error += long
+        ray.append((x, y))
+    return ray
+
+#the rays for every shot up to MAX_SHOOT_RANGE, worked out once here so that tracing one is
+#only a lookup. the sight rays hold the index offsets of the tiles between the two ends, the
+#ones that have to be see-through
+SHOT_RAYS = dict(((dx, dy), ray_offsets(dx, dy)) for dx in range(-MAX_SHOOT_RANGE, MAX_SHOOT_RANGE + 1)
+                 for dy in range(-MAX_SHOOT_RANGE, MAX_SHOOT_RANGE + 1))
+SIGHT_RAYS = dict((key, [x + y * MAP_WIDTH for (x, y) in ray[:-1]]) for (key, ray) in SHOT_RAYS.items())
+
+def shot_ray(dx, dy):
+    ray = SHOT_RAYS.get((dx, dy))
+    if ray is None:  #farther than any ranged monster shoots
+        ray = ray_offsets(dx, dy)
+    return ray
+
+def line_of_sight(x, y, target_x, target_y):
+    #True if no wall blocks the sight between the two tiles, along the same ray an arrow flies
+    global sight_traces
+    sight_traces += 1
+    return clear_line(x, y, target_x, target_y)
+
+def clear_line(x, y, target_x, target_y):
+    offsets = SIGHT_RAYS.get((target_x - x, target_y - y))
+    if offsets is None:
+        offsets = [dx + dy * MAP_WIDTH for (dx, dy) in ray_offsets(target_x - x, target_y - y)[:-1]]
+    block_sight = map.block_sight
+    i = x + y * MAP_WIDTH
+    for offset in offsets:
+        if block_sight[i + offset]:
+            return False
+    return True
+
+def sight_cache_hit_rate():
+    #fraction of the line of sight checks of RangedAIs that didn't need a new trace
+    if sight_traces + sight_reuses == 0:
+        return 0.0
+    return float(sight_reuses) / (sight_traces + sight_reuses)
+
+
+#offset masks for area effects, worked out the first time each radius is used
+DISC_MASKS = {}  #radius -> offsets
+
+def disc_offsets(radius):
+    #the offsets of the tiles at most radius away (like Object.distance), nearest first
+    mask = DISC_MASKS.get(radius)
+    if mask is None:
+        r = int(radius)
+        mask = [(dx, dy) for dy in range(-r, r + 1) for dx in range(-r, r + 1) if dx ** 2 + dy ** 2 <= radius ** 2]
+        mask.sort(key=lambda offset: (offset[0] ** 2 + offset[1] ** 2, offset[1], offset[0]))
+        DISC_MASKS[radius] = mask
+    return mask
+
+def area_cells(x, y, offsets, occluded=True):
+    #the tiles of an area around (x, y) that are on the map, as (x, y). with occluded, the
+    #ones hidden from (x, y) by a wall are left out, so the effect doesn't go through walls
+    cells = []
+    for (dx, dy) in offsets:
+        (cell_x, cell_y) = (x + dx, y + dy)
+        if 0 <= cell_x < MAP_WIDTH and 0 <= cell_y < MAP_HEIGHT and (not occluded or clear_line(x, y, cell_x, cell_y)):
+            cells.append((cell_x, cell_y))
+    return cells
+
+def fighters_in_area(x, y, offsets, occluded=True):
+    #the fighters standing in an area, looked up by tile in the occupancy index, so it costs
+    #as much as the area is big, however many objects there are
+    found = []
+    for (cell_x, cell_y) in area_cells(x, y, offsets, occluded):
+        for obj in occupancy.cells.get(cell_x + cell_y * MAP_WIDTH, ()):
+            if obj.fighter:
+                found.append(obj)
+    return found
+
+def nearest_fighter(x, y, max_range, accept):
+    #the closest fighter at most max_range away for which accept(obj) is True, or None. the
+    #tiles are looked at nearest first, so it stops at the first one found
+    for (dx, dy) in disc_offsets(max_range):
+        (cell_x, cell_y) = (x + dx, y + dy)
+        if 0 <= cell_x < MAP_WIDTH and 0 <= cell_y < MAP_HEIGHT:
+            for obj in occupancy.cells.get(cell_x + cell_y * MAP_WIDTH, ()):
+                if obj.fighter and accept(obj):
+                    return obj
+    return None
 
-        self.attack_type = 0
+
+class Projectile:
+    #an arrow flying from where it was shot towards the tile it was aimed at
+    def __init__(self, shooter, x, y, target_x, target_y, flown=0):
+        self.shooter = shooter
+        (self.x, self.y) = (x, y)  #where it was shot from
+        (self.target_x, self.target_y) = (target_x, target_y)
+        self.ray = shot_ray(target_x - x, target_y - y)
+        self.flown = flown  #tiles of the ray it has flown so far
+
+        #draw it as a line in about the direction it flies
+        (dx, dy) = (target_x - x, target_y - y)
+        if abs(dx) > 2 * abs(dy):
+            self.char = '-'
+        elif abs(dy) > 2 * abs(dx):
+            self.char = '|'
+        elif (dx > 0) == (dy > 0):
+            self.char = '\\'
+        else:
+            self.char = '/'
+
+    def position(self):
+        (dx, dy) = self.ray[self.flown - 1]
+        return (self.x + dx, self.y + dy)
+
+
+class Projectiles:
+    #the arrows in flight on the level. each one flies ARROW_SPEED tiles per tick along its
+    #ray, and stops at the first wall or blocking object on the way, or at the tile it was
+    #aimed at. it hits the player if that's where it stops
+    def __init__(self):
+        self.flying = []
+
+    def fire(self, shooter, target_x, target_y):
+        #it starts flying with the others, at the end of the tick it was shot on
+        self.flying.append(Projectile(shooter, shooter.x, shooter.y, target_x, target_y))
+
+    def run_tick(self):
+        if self.flying:
+            self.flying = [arrow for arrow in self.flying if not self.fly(arrow)]
+
+    def fly(self, arrow):
+        #returns True when the arrow stopped
+        if not arrow.ray:  #the shooter stands on the tile it aimed at
+            self.land(arrow, None)
+            return True
+        for i in range(ARROW_SPEED):
+            arrow.flown += 1
+            (x, y) = arrow.position()
+            if map.blocked[x + y * MAP_WIDTH] and map.block_sight[x + y * MAP_WIDTH]:
+                self.land(arrow, None)  #it hit a wall
+                return True
+            blocker = occupancy.blocking_at(x, y)
+            if blocker is not None or arrow.flown == len(arrow.ray):
+                self.land(arrow, blocker)
+                return True
+        return False
+
+    def land(self, arrow, blocker):
+        shooter = arrow.shooter
+        if shooter is None or shooter.fighter is None:
+            return  #its shooter is dead, it falls to the ground
+        if blocker is player:
+            if player.fighter.hp > 0:
+                shooter.fighter.attack(player)
+        else:
+            message('The ' + shooter.name + ' missed!', libtcod.light_blue)
 
 
 class RangedAI:
@@ -519,6 +1584,24 @@ class RangedAI:
         self.target_tile = None
         self.target_x = -1
         self.target_y = -1
+        self.sight = None  #((x, y, target x, target y), whether the target was in sight), see can_see()
+
+    def ticks_until_turn(self):
+        #it aims when its counter reaches speed - 1, and shoots on the tick after
+        if self.counter >= self.speed - 1:
+            return 1
+        return self.speed - 1 - self.counter
+
+    def can_see(self, target):
+        #line of sight to the target. it's traced again only after one of them moved
+        global sight_reuses
+        key = (self.owner.x, self.owner.y, target.x, target.y)
+        if self.sight is not None and self.sight[0] == key:
+            sight_reuses += 1
+            return self.sight[1]
+        visible = line_of_sight(*key)
+        self.sight = (key, visible)
+        return visible
 
     def take_turn(self):
         #a ranged monster's interal clock ticks
@@ -534,7 +1617,9 @@ class RangedAI:
 
         if player.fighter.hp > 0:
             if self.counter == self.speed - 1:
-                if self.owner.distance_to(player) <= self.shoot_range:
+                if stumbles(monster):
+                    return
+                if self.owner.distance_to(player) <= self.shoot_range and self.can_see(player):
                     self.target_x = player.x
                     self.target_y = player.y
                     self.target_tile = map[self.target_x][self.target_y]
@@ -544,10 +1629,7 @@ class RangedAI:
                 if self.target_tile:
                     self.target_tile.untarget(monster)
                     self.target_tile = None
-                    if player.x == self.target_x and player.y == self.target_y:
-                        monster.fighter.attack(player)
-                    else:
-                        message('The ' + monster.name + ' missed!', libtcod.light_blue)
+                    projectiles.fire(monster, self.target_x, self.target_y)
 
 
 class Item:
@@ -562,6 +1644,8 @@ class Item:
         else:
             inventory.append(self.owner)
             objects.remove(self.owner)
+            occupancy.remove(self.owner)
+            level_stats.object_removed(self.owner)
             message('You picked up a ' + self.owner.name + '!', libtcod.green)
 
             #special case: automatically equip, if the corresponding equipment slot is unused
@@ -584,8 +1668,8 @@ class Item:
         #first, dequip if it is equipped equipment
         if self.owner.equipment and self.owner.equipment.is_equipped:
             self.owner.equipment.dequip()
-            if self.owner.fighter.hp > self.owner.fighter.max_hp:
-                self.owner.fighter.hp = self.owner.fighter.max_hp
+            if player.fighter.hp > player.fighter.max_hp:
+                player.fighter.hp = player.fighter.max_hp
 
         #add to the map and remove from the player's inventory.
         #also, place it at the player's coordinates
@@ -593,6 +1677,8 @@ class Item:
         inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
+        occupancy.add(self.owner)
+        level_stats.object_added(self.owner)
         message('You dropped a ' + self.owner.name + '.', self.owner.color)
 
 
@@ -601,6 +1687,7 @@ class Equipment:
     def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
         self.slot = slot
         self.is_equipped = False
+        self.wearer = None  #the object wearing it, the player unless a monster carries it
         self.power_bonus = power_bonus
         self.defense_bonus = defense_bonus
         self.max_hp_bonus = max_hp_bonus
@@ -611,243 +1698,291 @@ class Equipment:
         else:
             self.equip()
 
-    def equip(self):
+    def equip(self, wearer=None):
         #dequip old equipment
-        old_equipment = get_equipped_in_slot(self.slot)
+        if wearer is None:
+            wearer = player
+        old_equipment = get_equipped_in_slot(self.slot, wearer)
         if old_equipment is not None:
             old_equipment.dequip()
 
         #equip object and show a message about it
         self.is_equipped = True
-        message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
+        self.wearer = wearer
+        wearer.fighter.equipped[self.slot] = self
+        wearer.fighter.equipment_changed()
+        if wearer is player:
+            message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
 
     def dequip(self):
         #dequip object and show a message about it
         if not self.is_equipped: return
         self.is_equipped = False
-        message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_green)
+        wearer = self.wearer
+        self.wearer = None
+        del wearer.fighter.equipped[self.slot]
+        wearer.fighter.equipment_changed()
+        if wearer is player:
+            message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_green)
+
+
+#the kinds of objects the factory makes are read from ENTITY_FILE. what was read is kept in
+#ENTITY_CACHE, marshalled like a .pyc, which is used instead for as long as the data file doesn't change
+ENTITY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'entities.json')
+ENTITY_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'entities.cache')
+ENTITY_CACHE_VERSION = 1  #bump it whenever read_entities() changes what it makes of the file
+ENTITY_FIELDS = {'char': None, 'name': None, 'color': None, 'blocks': False, 'always_visible': False,
+                 'place': 'front', 'global': None, 'fighter': None, 'ai': None, 'item': None,
+                 'equipment': None, 'pack': None}
+
+def plain(value):
+    #json reads strings as unicode, the game uses str
+    if isinstance(value, unicode):
+        return str(value)
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, dict):
+        return dict((str(key), plain(item)) for (key, item) in value.items())
+    return value
+
+def read_entities(path=ENTITY_FILE):
+    #the entity table in the data file: id -> entry, with every field of ENTITY_FIELDS
+    file = open(path, 'rb')
+    table = plain(json.load(file))
+    file.close()
+    entries = {}
+    for (id, entry) in table.items():
+        unknown = set(entry) - set(ENTITY_FIELDS)
+        if unknown:
+            raise ValueError('unknown fields in entity ' + id + ': ' + ', '.join(sorted(unknown)))
+        entries[id] = dict(ENTITY_FIELDS, **entry)
+    return entries
+
+def load_entities():
+    #the entity table, from the cache if it was made from the data file as it is now
+    info = os.stat(ENTITY_FILE)
+    stamp = (ENTITY_CACHE_VERSION, marshal.version, info.st_size, info.st_mtime)
+    try:
+        file = open(ENTITY_CACHE, 'rb')
+        (cached_stamp, entries) = marshal.load(file)
+        file.close()
+        if cached_stamp == stamp:
+            return entries
+    except:
+        pass  #there's no cache yet, or it can't be read
+    entries = read_entities()
+    try:
+        file = open(ENTITY_CACHE, 'wb')
+        marshal.dump((stamp, entries), file)
+        file.close()
+    except (IOError, OSError):
+        pass  #it's only a cache
+    return entries
+
+def entity_lookup(id, kind, name, table):
+    if name not in table:
+        raise ValueError('unknown ' + kind + ' ' + repr(name) + ' in entity ' + id)
+    return table[name]
+
+
+class Prototype:
+    #one kind of object the factory makes, from an entry of the entity table. the names in the entry
+    #are looked up once, here. the components are made anew for every object, as they hold its state
+    #(hp, paths, spawns...), but only from the arguments worked out here
+    def __init__(self, id, entry, ids):
+        self.id = id
+        self.pack = entry['pack']  #(id, count): that many objects of another kind, next to each other
+        if self.pack is not None:
+            entity_lookup(id, 'pack of', self.pack[0], ids)
+            return
+        self.char = entry['char']
+        self.name = entry['name']
+        self.color = getattr(libtcod, entry['color'], None)
+        if not isinstance(self.color, libtcod.Color):
+            raise ValueError('unknown color ' + repr(entry['color']) + ' in entity ' + id)
+        self.blocks = entry['blocks']
+        self.always_visible = entry['always_visible']
+        self.place = entity_lookup(id, 'place', entry['place'], {'front': ObjectFactory.append_front,
+                                                                 'back': ObjectFactory.append_back})
+        self.sets = entry['global']  #the global it's kept in, if any
+        if self.sets is not None:
+            entity_lookup(id, 'global', self.sets, {'player': None, 'stairs': None})
+
+        self.fighter = None
+        if entry['fighter'] is not None:
+            functions = dict((function.__name__, function) for function in SAVE_DEATH_FUNCTIONS if function)
+            self.fighter = dict(entry['fighter'])
+            self.fighter['death_function'] = entity_lookup(id, 'death function', self.fighter.get('death_function'), functions)
+        self.ai = entry['ai'] and self.compile_ai(entry['ai'])
+        self.use_function = None
+        if entry['item'] is not None:
+            functions = dict((function.__name__, function) for function in SAVE_USE_FUNCTIONS if function)
+            self.use_function = entity_lookup(id, 'use function', entry['item'], functions)
+        self.equipment = entry['equipment']
+
+    def compile_ai(self, spec):
+        #(AI class, its arguments, the spec of its sub AI or None)
+        spec = dict(spec)
+        classes = dict((ai_class.__name__, ai_class) for ai_class in SAVE_AI_CLASSES)
+        ai_class = entity_lookup(self.id, 'AI', spec.pop('class', None), classes)
+        sub_ai = spec.pop('sub_ai', None)
+        return (ai_class, spec, sub_ai and self.compile_ai(sub_ai))
+
+    def make_ai(self, spec):
+        (ai_class, arguments, sub_ai) = spec
+        if sub_ai is not None:
+            return ai_class(sub_ai=self.make_ai(sub_ai), **arguments)
+        return ai_class(**arguments)
+
+    def create(self, x, y):
+        if self.pack is not None:
+            return self.create_pack(x, y)
+        fighter = None
+        if self.fighter is not None:
+            fighter = Fighter(**self.fighter)
+        ai = None
+        if self.ai is not None:
+            ai = self.make_ai(self.ai)
+        item = None
+        if self.use_function is not None:
+            item = Item(use_function=self.use_function)
+        equipment = None
+        if self.equipment is not None:
+            equipment = Equipment(**self.equipment)
+        obj = Object(x, y, self.char, self.name, self.color, blocks=self.blocks, always_visible=self.always_visible,
+                     fighter=fighter, ai=ai, item=item, equipment=equipment)
+        if self.sets is not None:
+            globals()[self.sets] = obj
+        self.place(obj)
+        return obj
+
+    def create_pack(self, x, y):
+        #the first one on (x, y), the others on random free tiles around it
+        (id, count) = self.pack
+        first = ObjectFactory.create_object(id, x, y)
+        for i in range(count - 1):
+            while True:
+                x2 = rng.get_int('spawn', x - 1, x + 1)
+                y2 = rng.get_int('spawn', y - 1, y + 1)
+                if (x2 != x or y2 != y) and not is_blocked(x2, y2):
+                    break
+            ObjectFactory.create_object(id, x2, y2)
+        return first
 
 
 class ObjectFactory:
+    prototypes = None  #id -> Prototype, loaded on first use
+
+    @staticmethod
+    def load(entries=None):
+        #make the prototypes from an entity table, by default the one in ENTITY_FILE
+        if entries is None:
+            entries = load_entities()
+        ObjectFactory.prototypes = dict((id, Prototype(id, entry, entries)) for (id, entry) in entries.items())
+
     @staticmethod
     def append_front(obj):
         objects.append(obj)
+        occupancy.add(obj)
+        level_stats.object_added(obj)
+        if obj.ai:
+            scheduler.add(obj)
 
     @staticmethod
     def append_back(obj):
         objects.append(obj)
         obj.send_to_back()
+        occupancy.add(obj)
+        level_stats.object_added(obj)
+        if obj.ai:
+            scheduler.add(obj)
 
     @staticmethod
     def create_object(obj, x, y):
-        global player
-
-        if obj == 'player':
-            fighter_component = Fighter(hp=30, defense=2, power=5, xp=0, death_function=player_death)
-            player = Object(x, y, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
-            ObjectFactory.append_front(player)  #append to objects
-
-    ### MONSTERS ###
-
-        elif obj == 'goblin':
-            fighter_component = Fighter(hp=10, defense=0, power=3, xp=10, death_function=monster_death)
-            ai_component = BasicMonster(speed=2)
-            monster = Object(x, y, 'g', 'goblin', libtcod.dark_red, blocks=True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
+        #make an object of the kind with id obj and put it on the level, returns it
+        if ObjectFactory.prototypes is None:
+            ObjectFactory.load()
+        return ObjectFactory.prototypes[obj].create(x, y)
 
-        elif obj == 'goblinX2':
-            #Create a goblin
-            ObjectFactory.create_object('goblin', x, y)  #first goblin
-
-            #Create a second globin
-            x2 = 0
-            y2 = 0
-            while True:
-                x2 = libtcod.random_get_int(0, x - 1, x + 1)
-                y2 = libtcod.random_get_int(0, y - 1, y + 1)
-                if (x2 != x or y2 != y) and not is_blocked(x2, y2):
-                    break
-            ObjectFactory.create_object('goblin', x2, y2) #second goblin
-
-        elif obj == 'orc':
-            #create a an orc
-            fighter_component = Fighter(hp=20, defense=0, power=4, xp=20, death_function=monster_death)
-            ai_component = BasicMonster()
-            monster = Object(x, y, 'o', 'orc', libtcod.desaturated_green, blocks=True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
-
-        elif obj == 'troll':
-            #Create a troll
-            fighter_component = Fighter(hp=40, defense=1, power=10, xp=50, death_function=monster_death)
-            ai_component = BasicMonster(speed=4)
-            monster = Object(x, y, 'T', 'troll', libtcod.darker_green, blocks=True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
-
-        elif obj == 'nightmare':
-            #Create a nightmare
-            fighter_component = Fighter(hp=100, defense=10, power=10, xp=1000, death_function=monster_death)
-            ai_component = BasicMonster(speed=1)
-            monster = Object(x, y, 'N', 'nightmare', libtcod.darker_flame, blocks=True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
-
-        elif obj == 'fletchling':
-            #Create a fletchling
-            fighter_component = Fighter(hp=2, defense=5, power=7, xp=0, death_function=monster_death)
-            ai_component = BasicMonster(speed=2)
-            monster = Object(x, y, 'f', 'fletchling', libtcod.dark_flame, blocks = True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
-
-        elif obj == 'fletchling-gateway':
-            fighter_component = Fighter(hp=75, defense=0, power=0, xp=1000, death_function=gateway_death)
-            ai_component = GatewayAI('fletchling')
-            monster = Object(x, y, 'G', 'fletchling gateway', libtcod.dark_flame, blocks = True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
-
-        elif obj == 'goblin-prince':
-            fighter_component = Fighter(hp=200, defense=3, power=10, xp=1500, death_function=monster_death)
-            sub_ai_component = RangedAI(shoot_range=8)
-            ai_component = GoblinKingAI(sub_ai = sub_ai_component)
-            monster = Object(x, y, 'P', 'goblin prince', libtcod.black, blocks = True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
-
-        elif obj == 'archer':
-            fighter_component = Fighter(hp=60, defense=2, power=10, xp=300, death_function=monster_death)
-            ai_component = RangedAI()
-            monster = Object(x, y, 'a', 'archer', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-
-        elif obj == 'fast-archer':
-            fighter_component = Fighter(hp=100, defense=2, power=10, xp=500, death_function=monster_death)
-            ai_component-RangedAI(speed=2)
-            monster = Object(x, y, 'A', 'elite archer', libtcod.lighter_grey, blocks = True, fighter=fighter_component, ai=ai_component)
-
-    ## BOSSES ###
-        elif obj == 'goblin-king':
-            fighter_component = Fighter(hp=400, defense=4, power=12, xp=5000, death_function=boss_death)
-            sub_ai_component = RangedAI(shoot_range=15)
-            ai_component = GoblinKingAI(sub_ai=sub_ai_component)
-            monster = Object(x, y, 'K', 'Goblin King', libtcod.black, blocks = True, fighter=fighter_component, ai=ai_component)
-            ObjectFactory.append_front(monster)  #append to objects
-
-    ### ITEMS ###
-
-        elif obj == 'heal':
-            item_component = Item(use_function=cast_heal)
-            item = Object(x, y, '!', 'first-aid kit', libtcod.light_chartreuse, item=item_component)
-            ObjectFactory.append_back(item)  #append to objects
-
-        elif obj == 'confuse':
-            #create a confusion spell
-            item_component = Item(use_function=cast_confuse)
-            item = Object(x, y, '#', 'flashbang',libtcod.light_yellow, item=item_component)
-            ObjectFactory.append_back(item)  #append to objects
-
-        elif obj == 'fireball':
-            #create a fireball spell
-            item_component = Item(use_function=cast_fireball)
-            item = Object(x, y, '#', 'cloud of poison',libtcod.light_green, item=item_component)
-            ObjectFactory.append_back(item)  #append to objects
-
-        elif obj == 'lightning':
-            #create a lightning bolt spell
-            item_component = Item(use_function=cast_lightning)
-            item = Object(x, y, '#', 'ray gun', libtcod.light_blue, item=item_component)
-            ObjectFactory.append_back(item)  #append to objects
-
-    ### EQUIPMENT ###
-
-        elif obj == 'petty-sword':
-            #create a sword
-            equipment_component = Equipment(slot='right hand', power_bonus=2)
-            item = Object(x, y, '/', 'rusty pole', libtcod.darkest_orange, equipment=equipment_component)
-            ObjectFactory.append_back(item)  #append to objects
-
-        elif obj == 'petty-shield':
-            #create a shield
-            equipment_component = Equipment(slot='left hand', defense_bonus=2)
-            item = Object(x, y, '+', 'metal plate', libtcod.silver, equipment=equipment_component)
-            ObjectFactory.append_back(item)  #append to objects
-
-        elif obj == 'petty-breastplate':
-            #create a breastplate
-            equipment_component = Equipment(slot='chest', max_hp_bonus=30)
-            item = Object(x, y, '&', 'thick vest', libtcod.sepia, equipment=equipment_component)
-            ObjectFactory.append_back(item)  #append to objects
-
-    ### STAIRS ###
-
-        elif obj == 'stairs':
-            global stairs
-            #create stairs
-            stairs = Object(x, y, '<', 'stairs', libtcod.white, always_visible=True)
-            ObjectFactory.append_back(stairs)  #append to objects
-
-        elif obj == 'late-stairs':
-            global stairs
-            #create stairs later in the game
-            stairs = Object(x, y, '<', 'stairs', libtcod.white, always_visible=True)
-            ObjectFactory.append_front(stairs)  #append to objects
 
+def player_distance(x, y):
+    #number of steps from (x, y) to the player around walls (-1 if there is no way), from a
+    #distance map that every monster shares and that is only computed again after the player moved
+    global player_dijkstra_origin
+    if player_dijkstra_origin != (player.x, player.y):
+        libtcod.dijkstra_compute(player_dijkstra, player.x, player.y)
+        player_dijkstra_origin = (player.x, player.y)
+    return libtcod.dijkstra_get_distance(player_dijkstra, x, y)
 
 def is_blocked(x, y):
     #first test the map tile
-    if map[x][y].blocked:
+    if map.blocked[x + y * MAP_WIDTH]:
         return True
 
     #now check for any blocking objects
-    for object in objects:
-        if object.blocks and object.x == x and object.y == y:
-            return True
-
-    return False
-
-def get_all_equipped(obj):  #returns a list of equipped items
-    if obj == player:
-        equipped_list = []
-        for item in inventory:
-            if item.equipment and item.equipment.is_equipped:
-                equipped_list.append(item.equipment)
-        return equipped_list
-    else:
-        return []  #other objects have no equipment
-
-def get_equipped_in_slot(slot):  #returns the equipment in a slot, or None if it's empty
-    for obj in inventory:
-        if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
-            return obj.equipment
-    return None
+    return occupancy.blocking_at(x, y) is not None
+
+def get_equipped_in_slot(slot, obj=None):  #returns the equipment in a slot of obj (the player by default), or None if it's empty
+    if obj is None:
+        obj = player
+    return obj.fighter.equipped.get(slot)
+
+def drop_equipment(monster):
+    #the equipment a monster carried falls to the ground where it died
+    for slot in sorted(monster.fighter.equipped):
+        equipment = monster.fighter.equipped[slot]
+        equipment.dequip()
+        item = equipment.owner
+        (item.x, item.y) = (monster.x, monster.y)
+        ObjectFactory.append_back(item)
 
 def create_room(room):
     global map
     #go through the tiles in the rectangle and make them passable
     for x in range(room.x1 + 1, room.x2):
         for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+            map.carve(x, y)
  
 def create_h_tunnel(x1, x2, y):
     global map
     #horizontal tunnel. min() and max() are used in case x1>x2
     for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+        map.carve(x, y)
  
 def create_v_tunnel(y1, y2, x):
     global map
     #vertical tunnel
     for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+        map.carve(x, y)
+
+def reset_level_state(level_objects, rebuild=False, room_of=None, sleepers=()):
+    #start everything that belongs to one level for a list of objects: the occupancy index, level
+    #stats, turn scheduler, wake zones, arrows, noise and gateway spawn budget. a level being made
+    #starts them empty; with rebuild, they're built from the map and objects of a level made
+    #elsewhere (a loaded game or a pregenerated level), with room_of and the sleepers for the wake zones
+    global objects, occupancy, level_stats, scheduler, wake_zones, spawn_budget, projectiles, noise
+    objects = level_objects
+    occupancy = OccupancyIndex.build(objects, MAP_WIDTH)
+    if rebuild:
+        level_stats = LevelStats.build(map, objects)
+        scheduler = TurnScheduler.build(objects)
+        wake_zones = WakeZones.build(map.width, map.height, room_of, sleepers)  #after the scheduler
+    else:
+        level_stats = LevelStats()
+        scheduler = TurnScheduler()
+        wake_zones = WakeZones(MAP_WIDTH, MAP_HEIGHT)
+    projectiles = Projectiles()
+    noise = NoiseField()
+    spawn_budget = LEVEL_SPAWN_BUDGET
 
 def make_boss_map():
-    global map, objects
+    global map
 
-    #the list of objects with player in it
-    objects = [player]
+    #the list of objects with player in it. nothing sleeps on the boss level
+    reset_level_state([player])
 
     #fill map with "blocked" tiles
-    map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    map = TileGrid(MAP_WIDTH, MAP_HEIGHT, True)
  
     num_rooms = 0
     rooms = []
@@ -859,8 +1994,7 @@ def make_boss_map():
     rooms.append(new_room)
 
     #this is the first room, where the player starts at
-    player.x = new_x
-    player.y = new_y
+    occupancy.move(player, new_x, new_y)
     num_rooms += 1
 
     #This is the main boss room
@@ -904,27 +2038,27 @@ def make_boss_map():
     ObjectFactory.create_object('troll', new_x, new_y + 1)
     num_rooms += 1
 
+    level_stats.count_tiles(map)
+
 def make_map():
-    global map, objects, stairs
+    global map, stairs
  
     #the list of objects with player in it
-    objects = [player]
+    reset_level_state([player])
 
     #fill map with "blocked" tiles
-    map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    map = TileGrid(MAP_WIDTH, MAP_HEIGHT, True)
  
     rooms = []
     num_rooms = 0
  
     for r in range(MAX_ROOMS):
         #random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = rng.get_int('mapgen', ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = rng.get_int('mapgen', ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         #random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = rng.get_int('mapgen', 0, MAP_WIDTH - w - 1)
+        y = rng.get_int('mapgen', 0, MAP_HEIGHT - h - 1)
  
         #"Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -947,8 +2081,7 @@ def make_map():
  
             if num_rooms == 0:
                 #this is the first room, where the player starts at
-                player.x = new_x
-                player.y = new_y
+                occupancy.move(player, new_x, new_y)
             else:
                 #all rooms after the first:
                 #connect it to the previous room with a tunnel
@@ -957,7 +2090,7 @@ def make_map():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
  
                 #draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if rng.get_int('mapgen', 0, 1) == 1:
                     #first move horizontally, then vertically
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -966,8 +2099,9 @@ def make_map():
                     create_v_tunnel(prev_y, new_y, prev_x)
                     create_h_tunnel(prev_x, new_x, new_y)
  
-            #add some contents to this room, such as monsters
+            #add some contents to this room, such as monsters, which sleep until the player comes by
             place_objects(new_room)
+            wake_zones.add_room(new_room)
 
             #finally, append the new room to the list
             rooms.append(new_room)
@@ -976,6 +2110,9 @@ def make_map():
     #create stairs at the center of the Last room
     ObjectFactory.create_object('stairs', new_x, new_y)
 
+    level_stats.count_tiles(map)
+    wake_zones.player_moved(player.x, player.y)  #the monsters in the first room are awake
+
 def place_objects(room):
     #choose random number of monsters
     max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6], [7, 9], [0, 10]])
@@ -1002,15 +2139,15 @@ def place_objects(room):
     item_chances['petty-breastplate'] = 1
 
     #randomize value of monsters per room
-    num_monsters = libtcod.random_get_int(0, 0, max_monsters)
+    num_monsters = rng.get_int('spawn', 0, max_monsters)
 
     for i in range(num_monsters):
         #choose random spot for this monster
         x = 0
         y = 0
         while True:
-            x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-            y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+            x = rng.get_int('spawn', room.x1+1, room.x2-1)
+            y = rng.get_int('spawn', room.y1+1, room.y2-1)
             if not is_blocked(x, y):
                 break
         choice = random_choice(monster_chances)
@@ -1018,28 +2155,28 @@ def place_objects(room):
             
 
     #choose random number of items
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    num_items = rng.get_int('loot', 0, max_items)
 
     for i in range(num_items):
         while True:
             #choose random spot for this item
-            x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-            y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+            x = rng.get_int('loot', room.x1 + 1, room.x2 - 1)
+            y = rng.get_int('loot', room.y1 + 1, room.y2 - 1)
             if not is_blocked(x, y):
                 break;
 
-        choice = random_choice(item_chances)
+        choice = random_choice(item_chances, 'loot')
         ObjectFactory.create_object(choice, x, y)
 
-def random_choice(chances_dict):
+def random_choice(chances_dict, stream='spawn'):
     #choose one option from dictionary of chances, returning its key
     chances = chances_dict.values()
     strings = chances_dict.keys()
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, stream)]
 
-def random_choice_index(chances):  #choose one option from list of chances, returning its index
+def random_choice_index(chances, stream='spawn'):  #choose one option from list of chances, returning its index
     #the dice will land on some number between 1 and the sum of the chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
+    dice = rng.get_int(stream, 1, sum(chances))
 
     #go through all chances, keeping the sum so far
     running_sum = 0
@@ -1084,52 +2221,109 @@ def get_names_under_mouse():
     (x, y) = (mouse.cx, mouse.cy)
 
     #create a list with the names of all objects at the mouse's coordinates and in FOV
-    names = [obj.name for obj in objects
-        if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    if not libtcod.map_is_in_fov(fov_map, x, y):
+        return ''
+    names = [obj.name for obj in occupancy.objects_at(x, y)]
     names = ', '.join(names)
 
     return names.capitalize()
 
+def tile_color_code(i):
+    #which background a tile should have, as an index into tile_colors
+    wall = map.block_sight[i]
+    if i not in visible_cells:
+        #if it's not visible right now, the player can only see it if it's explored
+        if not map.explored[i]:
+            return 0
+        if wall:
+            return 1  #dark wall
+        return 2  #dark ground
+    #it's visible
+    if wall:
+        return 3  #light wall
+    if map.targeted[i]:
+        return 5  #targeted ground
+    return 4  #light ground
+
+def all_tile_color_codes():
+    #tile_color_code() for the whole map at once, from the tile layers and the visible cells
+    if numpy_available:
+        wall = numpy.frombuffer(map.block_sight, numpy.uint8)
+        codes = numpy.where(numpy.frombuffer(map.explored, numpy.uint8), 2 - wall, 0).astype(numpy.uint8)
+        if visible_cells:
+            visible = numpy.fromiter(visible_cells, numpy.intp, len(visible_cells))
+            targeted = numpy.frombuffer(map.targeted, numpy.uint8)
+            codes[visible] = numpy.where(wall[visible], 3, numpy.where(targeted[visible], 5, 4))
+        return bytearray(codes)
+
+    codes = bytearray(2 - wall if seen else 0 for (seen, wall) in zip(map.explored, map.block_sight))
+    block_sight = map.block_sight
+    targeted = map.targeted
+    for i in visible_cells:
+        if block_sight[i]:
+            codes[i] = 3
+        elif targeted[i]:
+            codes[i] = 5
+        else:
+            codes[i] = 4
+    return codes
+
+def paint_all_tiles():
+    #set the background of the whole console with one call, instead of one call per tile
+    global painted
+    painted = all_tile_color_codes()
+
+    #lay the map's rows out in the console's rows, the rest of the console is black
+    codes = bytearray(SCREEN_WIDTH * SCREEN_HEIGHT)
+    for y in range(MAP_HEIGHT):
+        codes[y * SCREEN_WIDTH:y * SCREEN_WIDTH + MAP_WIDTH] = painted[y * MAP_WIDTH:(y + 1) * MAP_WIDTH]
+
+    (r, g, b) = (codes.translate(palette_r), codes.translate(palette_g), codes.translate(palette_b))
+    if numpy_available:
+        (r, g, b) = (numpy.frombuffer(r, numpy.uint8), numpy.frombuffer(g, numpy.uint8), numpy.frombuffer(b, numpy.uint8))
+    libtcod.console_fill_background(con, r, g, b)
+
 def render_all():
-    global fov_map, color_dark_wall, color_light_wall
-    global color_dark_ground, color_light_ground
-    global fov_recompute
- 
-    #just testing
-    fov_recompute = True
+    global fov_recompute, frame_dirty, mouse_cell, drawn_cells
+
     if fov_recompute:
         #recompute FOV if needed (the player moved or something)
-        fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
- 
-        #go through all tiles, and set their background color according to the FOV
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = libtcod.map_is_in_fov(fov_map, x, y)
-                wall = map[x][y].block_sight
-                if not visible:
-                    #if it's not visible right now, the player can only see it if it's explored
-                    if map[x][y].explored:
-                        if wall:
-                            libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-                        else:
-                            libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-                else:
-                    #it's visible
-                    if wall:
-                        libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-                    else:
-                        if map[x][y].targeted:
-                            libtcod.console_set_char_background(con, x, y, color_target_ground, libtcod.BKGND_SET )
-                        else:
-                            libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-                    #since it's visible, explore it
-                    map[x][y].explored = True
- 
-    #draw all objects in the list
+        compute_fov()
+
+    #the names under the mouse have to be updated when it moves to another cell
+    if (mouse.cx, mouse.cy) != mouse_cell:
+        mouse_cell = (mouse.cx, mouse.cy)
+        frame_dirty = True
+
+    dirty = map.dirty
+    if not dirty and not frame_dirty:
+        return  #nothing changed since the last frame
+
+    #set the background color of the tiles that changed, according to the FOV
+    if len(dirty) > BULK_PAINT_THRESHOLD:
+        paint_all_tiles()
+    else:
+        for i in dirty:
+            code = tile_color_code(i)
+            if code != painted[i]:
+                painted[i] = code
+                libtcod.console_set_char_background(con, i % MAP_WIDTH, i // MAP_WIDTH, tile_colors[code], libtcod.BKGND_SET)
+    dirty.clear()
+
+    #erase the objects drawn in the last frame, then draw all objects in the list
+    for (x, y) in drawn_cells:
+        libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+    drawn_cells = []
     for object in objects:
-        object.draw()
+        if object.draw():
+            drawn_cells.append((object.x, object.y))
     player.draw()
+    for arrow in projectiles.flying:
+        (x, y) = arrow.position()
+        if libtcod.map_is_in_fov(fov_map, x, y):
+            libtcod.console_set_default_foreground(con, libtcod.white)
+            libtcod.console_put_char(con, x, y, arrow.char, libtcod.BKGND_NONE)
+            drawn_cells.append((x, y))
  
     #blit the contents of "con" to the root console
     libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
@@ -1143,13 +2337,12 @@ def render_all():
 
     #show the current dungeon level
     libtcod.console_print_ex(panel, 1, 3, libtcod.BKGND_NONE, libtcod.LEFT, 'Test #' + str(dungeon_level))
-    (map_count, map_explored) = count_remaining_tiles()
     #show the amount of exploration remaining in the level
-    libtcod.console_print_ex(panel, 1, 4, libtcod.BKGND_NONE, libtcod.LEFT, 'Explored: ' + str(map_explored) + '/' + str(map_count))
+    libtcod.console_print_ex(panel, 1, 4, libtcod.BKGND_NONE, libtcod.LEFT, 'Explored: ' + str(level_stats.explored_tiles) + '/' + str(level_stats.floor_tiles))
     #show the amount of enemies remaining in the level
-    libtcod.console_print_ex(panel, 1, 5, libtcod.BKGND_NONE, libtcod.LEFT, 'Remaining enemies: ' + str(count_remaining_enemies()))
-    #show the amount of enemies remaining in the level
-    libtcod.console_print_ex(panel, 1, 6, libtcod.BKGND_NONE, libtcod.LEFT, 'Remaining items: ' + str(count_remaining_items()))
+    libtcod.console_print_ex(panel, 1, 5, libtcod.BKGND_NONE, libtcod.LEFT, 'Remaining enemies: ' + str(level_stats.enemies))
+    #show the amount of items remaining in the level
+    libtcod.console_print_ex(panel, 1, 6, libtcod.BKGND_NONE, libtcod.LEFT, 'Remaining items: ' + str(level_stats.items))
 
     #display names of objects under the mouse
     libtcod.console_set_default_foreground(panel, libtcod.light_gray)
@@ -1164,9 +2357,40 @@ def render_all():
 
     #blit the contents of "panel" to the root console
     libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+    frame_dirty = False
+
+def compute_fov():
+    #recompute the player's FOV, without drawing anything. the tiles that came into
+    #or went out of view are marked to be drawn again, and the visible ones are explored
+    global fov_recompute, visible_cells
+    fov_recompute = False
+    libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+
+    #the FOV can't reach further than the torch, so only that box has to be checked
+    if TORCH_RADIUS > 0:
+        (x1, x2) = (max(0, player.x - TORCH_RADIUS), min(MAP_WIDTH, player.x + TORCH_RADIUS + 1))
+        (y1, y2) = (max(0, player.y - TORCH_RADIUS), min(MAP_HEIGHT, player.y + TORCH_RADIUS + 1))
+    else:
+        (x1, x2, y1, y2) = (0, MAP_WIDTH, 0, MAP_HEIGHT)
+    new_visible = set()
+    for y in range(y1, y2):
+        for x in range(x1, x2):
+            if libtcod.map_is_in_fov(fov_map, x, y):
+                new_visible.add(x + y * MAP_WIDTH)
+
+    map.dirty.update(visible_cells.symmetric_difference(new_visible))
+    visible_cells = new_visible
+    blocked = map.blocked
+    explored = map.explored
+    for i in new_visible:
+        if not explored[i]:
+            explored[i] = 1
+            if not blocked[i]:
+                level_stats.explored_tiles += 1
 
 def message(new_msg, color=libtcod.white):
-    global game_msgs
+    global game_msgs, frame_dirty
+    frame_dirty = True
     #split the message if necessary, among multiple lines
     new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
 
@@ -1179,24 +2403,26 @@ def message(new_msg, color=libtcod.white):
         game_msgs.append( (line, color) )
 
 def player_move_or_attack(dx, dy):
-    global fov_recompute
+    global fov_recompute, frame_dirty
+
+    if status.has(player, 'confused'):  #they stumble in a random direction, never in place (they'd hit themselves)
+        (dx, dy) = STEP_DIRECTIONS[rng.get_int('ai', 0, len(STEP_DIRECTIONS) - 1)]
 
     #the coordinates the player is moving to/attacking
     x = player.x + dx
     y = player.y + dy
+    frame_dirty = True
 
     #try to find an attackable object there
-    target = None
-    for object in objects:
-        if object.fighter and object.x == x and object.y == y:
-            target = object
-            break
+    target = occupancy.fighter_at(x, y)
 
     #attack if target found, move otherwise
     if target is not None:
         player.fighter.attack(target)
     else:
         player.move(dx, dy)
+        wake_zones.player_moved(player.x, player.y)
+        noise.emit(player.x, player.y, NOISE_STEP)
         fov_recompute = True
 
 def check_level_up():
@@ -1210,6 +2436,8 @@ def check_level_up():
         message("You're making things interesting, Runner! You've become level " + str(player.level) + '.', libtcod.yellow)
 
         choice = None
+        if headless:  #no menu to ask with, always take the medal of survival
+            choice = 0
         while choice == None:  #keep asking until a choice is made
             choice = menu('For your efforts, we will give you one reward. Choose wisely:\n',
                 ['Medal of Survival (+15 Max HP, +10 HP)',
@@ -1244,6 +2472,7 @@ def check_level_up():
                     message('You received two ray guns!', libtcod.lighter_blue)
 
 def menu(header, options, width):
+    global frame_dirty
     if len(options) > MAX_INVENTORY: raise ValueError('Cannot have a menu with more than ' + str(MAX_INVENTORY) + ' options.')
 
     #calculate total height for the header (after auto-wrap) and one Line per option
@@ -1275,6 +2504,7 @@ def menu(header, options, width):
 
     libtcod.console_flush()
     key = libtcod.console_wait_for_keypress(True)
+    frame_dirty = True  #the menu was drawn over the map, so draw everything again
 
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         #Alt+Enter: toggle fullscreen
@@ -1307,32 +2537,6 @@ def inventory_menu(header):
     if index is None or len(inventory) == 0: return index
     return inventory[index].item
 
-def count_remaining_items():
-    count = 0
-    for obj in objects:
-        if obj.item:
-            count += 1
-    return count
-
-def count_remaining_enemies():
-    count = 0
-    for obj in objects:
-        if obj.fighter and obj != player:
-            count += 1
-    return count
-
-def count_remaining_tiles():
-    count_map = 0
-    count_explored = 0
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            tile = map[x][y]
-            if not tile.blocked:
-                count_map += 1
-                if tile.explored:
-                    count_explored += 1
-    return (count_map, count_explored)
-
 def handle_keys():
     global key
  
@@ -1362,10 +2566,9 @@ def handle_keys():
 
             if key_char == 'g':
                 #pick up an item
-                for object in objects:  #look for an item in the player's tile
-                    if object.x == player.x and object.y == player.y and object.item:
-                        object.item.pick_up()
-                        break
+                items = occupancy.items_at(player.x, player.y)  #look for an item in the player's tile
+                if items:
+                    items[0].item.pick_up()
             elif key_char == 'i':
                 #show the inventory
                 chosen_item = inventory_menu('Press the key next to an item to use it, or any other to cancel.\n')
@@ -1401,21 +2604,37 @@ def monster_death(monster):
     #transform it into a nasty corpse! it doesn't block, can't be
     #attacked, and doesn't move
     message(monster.name.capitalize() + ' is dead! You gained ' + str(monster.fighter.xp) + ' experience.', libtcod.dark_orange)
+    drop_equipment(monster)
     monster.char = '%'
     monster.color = libtcod.dark_red
     monster.blocks = False
+    occupancy.update_blocking(monster)
+    level_stats.enemies -= 1
     monster.fighter = None
     monster.ai = None
     monster.name = 'remains of ' + monster.name
     monster.send_to_back()
     check_level_up()
 
+def spawn_death(monster):
+    #a monster spawned by a gateway crumbles away. it's taken off the level (no corpse is left
+    #behind) and kept by its gateway, to be spawned again
+    message(monster.name.capitalize() + ' crumbles away! You gained ' + str(monster.fighter.xp) + ' experience.', libtcod.dark_orange)
+    objects.remove(monster)
+    occupancy.remove(monster)
+    level_stats.object_removed(monster)
+    scheduler.suspend(monster)
+    status.clear(monster)  #it comes back with its own wits
+    check_level_up()
+
 def gateway_death(gateway):
     #turn the gateway into rubble
     message('The ' + gateway.name + 'is destroyed! You gained ' + str(gateway.fighter.xp) + ' experience.', libtcod.dark_orange)
     gateway.char = '%'
     gateway.color = libtcod.darkest_orange
     gateway.blocks = False
+    occupancy.update_blocking(gateway)
+    level_stats.enemies -= 1
     gateway.fighter = None
     gateway.ai = None
     gateway.name = 'rubble'
@@ -1425,8 +2644,11 @@ def gateway_death(gateway):
 def boss_death(boss):
     #turn the boss into a corpse
     message('You defeated the ' + boss.name + '! Your reward is ' + str(boss.fighter.xp) + ' experience!', libtcod.dark_orange)
+    drop_equipment(boss)
     boss.char = '%'
     boss.blocks = False
+    occupancy.update_blocking(boss)
+    level_stats.enemies -= 1
     boss.fighter = None
     boss.ai = None
     boss.name = 'remnants of ' + boss.name
@@ -1434,8 +2656,8 @@ def boss_death(boss):
     x = 0
     y = 0
     while True:
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH-1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT-1)
+        x = rng.get_int('spawn', 0, MAP_WIDTH-1)
+        y = rng.get_int('spawn', 0, MAP_HEIGHT-1)
         if not is_blocked(x, y):
             break
     ObjectFactory.create_object('late-stairs', x, y)
@@ -1467,22 +2689,14 @@ def target_monster(max_range=None):
             return None
 
         #return the first clicked monster, otherwise continue looping
-        for obj in objects:
-            if obj.x == x and obj.y == y and obj.fighter and obj != player:
+        for obj in occupancy.objects_at(x, y):
+            if obj.fighter and obj != player:
                 return obj
 
 def closest_monster(max_range):
     #find closest enemy, up to a maximum range, and in the player's FOV
-    closest_enemy = None
-    closest_dist = max_range + 1  #start with (slightly more than) maximum range
-
-    for object in objects:
-        if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
-            dist = player.distance_to(object)
-            if dist < closest_dist:  #it's closer, so remember it
-                closest_enemy = object
-                closest_dist = dist
-    return closest_enemy
+    return nearest_fighter(player.x, player.y, max_range,
+                           lambda obj: obj is not player and libtcod.map_is_in_fov(fov_map, obj.x, obj.y))
 
 def cast_heal():
     global player
@@ -1503,6 +2717,7 @@ def cast_lightning():
 
     #zap it!
     message('You shot a bolt of lightning at the ' + monster.name + '! The damage is ' + str(LIGHTNING_DAMAGE) + ' hit points.', libtcod.light_blue)
+    noise.emit(monster.x, monster.y, NOISE_LIGHTNING)
     monster.fighter.take_damage(LIGHTNING_DAMAGE)
 
 def cast_confuse():
@@ -1511,10 +2726,9 @@ def cast_confuse():
     monster = target_monster(CONFUSE_RANGE)
     if monster is None: return 'cancelled'
 
-    #replace the monster's AI with a "confused" one; after some turns it will restore the old AI
-    old_ai = monster.ai
-    monster.ai = ConfusedMonster(old_ai)
-    monster.ai.owner = monster  #tell the new component who owns it
+    #it stumbles around instead of taking its next few turns
+    speed = getattr(monster.ai, 'speed', None) or CONFUSE_DEFAULT_SPEED
+    status.apply(monster, 'confused', CONFUSE_NUM_TURNS * speed)
     message('The ' + monster.name + ' was caught in the flashbang, and has become disoriented!', libtcod.lighter_yellow)
 
 def cast_fireball():
@@ -1524,18 +2738,21 @@ def cast_fireball():
     (x, y) = target_tile()
     if x is None: return 'cancelled'
     message('The noxious cloud rapidly expands ' + str(FIREBALL_RADIUS) + ' tiles from where you threw the vial.', libtcod.lighter_green)
+    noise.emit(x, y, NOISE_FIREBALL)
 
-    for obj in objects:  #damage every fighter in range, including the player
-        if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
-            message('The ' + obj.name + ' is poisoned, dealing ' + str(FIREBALL_DAMAGE) + ' hit points.', libtcod.light_green)
-            obj.fighter.take_damage(FIREBALL_DAMAGE)
+    for obj in fighters_in_area(x, y, disc_offsets(FIREBALL_RADIUS)):  #damage every fighter the cloud reaches, including the player
+        message('The ' + obj.name + ' is poisoned, dealing ' + str(FIREBALL_DAMAGE) + ' hit points.', libtcod.light_green)
+        obj.fighter.take_damage(FIREBALL_DAMAGE)
 
-def new_game():
-    global player, objects, inventory, game_msgs, game_state, dungeon_level
+def new_game(seed=None):
+    #pass a seed to replay the exact same levels and turns
+    global player, status, inventory, game_msgs, game_state, dungeon_level, rng
 
     dungeon_level = 1
+    rng = RandomStreams(seed)
 
-    objects = []
+    reset_level_state([])  #for the player to be put in, until the first level is made
+    status = StatusEffects()
 
     #create objct representing the player
     ObjectFactory.create_object('player', SCREEN_WIDTH/2, SCREEN_HEIGHT/2)
@@ -1549,8 +2766,9 @@ def new_game():
     ######################
 
     #generate map (at this point it's not drawn to the screen)
-    make_map()
+    make_level()
     initialize_fov()
+    start_pregeneration()
 
     game_state = 'playing'
     inventory = []
@@ -1560,17 +2778,43 @@ def new_game():
 
     message('Welcome, Runner #43! Please refrain from spilling your blood on the walls!', libtcod.red)
 
+def fill_fov_map(fov_map):
+    #make a libtcod map's tiles see-through and walkable like the map's
+    blocked = map.blocked
+    block_sight = map.block_sight
+    for y in range(MAP_HEIGHT):
+        for x in range(MAP_WIDTH):
+            i = x + y * MAP_WIDTH
+            libtcod.map_set_properties(fov_map, x, y, not block_sight[i], not blocked[i])
+
 def initialize_fov():
-    global fov_recompute, fov_map
+    global fov_recompute, fov_map, frame_dirty, visible_cells, painted, drawn_cells
+    global player_dijkstra, player_dijkstra_origin, astar_path, monster_sight
     fov_recompute = True
 
-    libtcod.console_clear(con)
+    #nothing is painted anymore, so every tile has to be drawn again
+    frame_dirty = True
+    visible_cells = set()
+    painted = bytearray(MAP_WIDTH * MAP_HEIGHT)
+    drawn_cells = []
+    map.dirty.update(range(MAP_WIDTH * MAP_HEIGHT))
+    if not headless:
+        libtcod.console_clear(con)
 
     #create the FOV map, according to the generated map
     fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+    fill_fov_map(fov_map)
+    monster_sight = SightCache()
+
+    #the distance map for monsters chasing the player walks the same tiles. a diagonal step
+    #costs the same as a straight one, since both take a monster one turn
+    if player_dijkstra is not None:
+        libtcod.dijkstra_delete(player_dijkstra)
+    player_dijkstra = libtcod.dijkstra_new(fov_map, 1.0)
+    player_dijkstra_origin = None
+    if astar_path is not None:
+        libtcod.path_delete(astar_path)
+    astar_path = libtcod.path_new_using_map(fov_map, 1.0)
 
 def play_game():
     global key, mouse
@@ -1586,10 +2830,6 @@ def play_game():
      
         libtcod.console_flush()
      
-        #erase all objects at their old locations, before they move
-        for object in objects:
-            object.clear()
-     
         #handle keys and exit game if needed
         player_action = handle_keys()
         if player_action == 'exit':
@@ -1598,9 +2838,16 @@ def play_game():
 
         #let monsters take their turn
         if game_state == 'playing' and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
+            monsters_take_turn()
+
+def monsters_take_turn():
+    #only the monsters whose turn it actually is get woken up
+    global frame_dirty
+    frame_dirty = True
+    status.run_tick()
+    noise.run_tick()
+    scheduler.run_tick()
+    projectiles.run_tick()
 
 def next_level():
     global dungeon_level
@@ -1609,11 +2856,72 @@ def next_level():
 
     dungeon_level += 1
     message('On to the next trial, Runner #43!', libtcod.dark_violet)
+    status.keep_only(player)  #the monsters it affected stay behind
+
+    #use the level made in the background if there is one, it's the same as making it now
+    level = None
+    if pregenerate_levels:
+        level = level_pregenerator.take(rng.seed, dungeon_level)
+    if level is not None:
+        install_level(level)
+    else:
+        make_level()
+    initialize_fov()
+    start_pregeneration()
+
+def make_level():
+    #make the map for the current dungeon level
+    rng.start_level(dungeon_level)
     if dungeon_level != 10:
         make_map()
     else:
         make_boss_map()
-    initialize_fov()
+
+def start_pregeneration():
+    #start making the level after this one in the background
+    if pregenerate_levels:
+        level_pregenerator.start(rng.seed, dungeon_level + 1)
+
+def generate_level(seed, level):
+    #make a level just like next_level would, and return it to be passed to install_level.
+    #this runs in LevelPregenerator's worker process, so it can replace the globals freely
+    global dungeon_level, rng
+    dungeon_level = level
+    rng = RandomStreams(seed)
+    reset_level_state([])
+    ObjectFactory.create_object('player', 0, 0)
+    make_level()
+
+    try:
+        stairs_index = objects.index(stairs)
+    except:
+        stairs_index = -1
+    return {'map': map, 'objects': objects, 'player_index': objects.index(player), 'stairs_index': stairs_index,
+            'rng': [(name, rng.streams[name].getstate()) for name in LEVEL_RNG_STREAMS],
+            'room_of': bytes(wake_zones.room_of),
+            'sleepers': [index for (index, obj) in enumerate(objects) if wake_zones.is_asleep(obj)],
+            'spawn_budget': spawn_budget}
+
+def install_level(level):
+    #make a level returned by generate_level the current one
+    global map, objects, spawn_budget, stairs
+    map = level['map']
+    objects = level['objects']
+
+    #the level was made with a stand-in for the player, put the real one in its place
+    stand_in = objects[level['player_index']]
+    objects[level['player_index']] = player
+    player.x = stand_in.x
+    player.y = stand_in.y
+    if level['stairs_index'] != -1:
+        stairs = objects[level['stairs_index']]
+
+    #leave the level streams as if the level had been made here
+    for (name, state) in level['rng']:
+        rng.streams[name].setstate(state)
+
+    reset_level_state(objects, rebuild=True, room_of=level['room_of'], sleepers=[objects[i] for i in level['sleepers']])
+    spawn_budget = level['spawn_budget']
 
 def main_menu():
     img = libtcod.image_load('main_background.png')
@@ -1644,49 +2952,476 @@ def main_menu():
         elif choice == 2:  #quit
             break
 
+
+#############################################
+# Save Files
+#############################################
+
+#the savegame is one binary file: a header, a string table (names, slots, messages...), then
+#fixed-layout records for the map, the objects and their components, and the rest of the game.
+#bump SAVE_VERSION whenever a record changes
+SAVE_FILE = 'savegame'
+SAVE_MAGIC = b'RNRS'
+SAVE_VERSION = 11
+
+SAVE_HEADER = struct.Struct('<4sH')  #magic, version
+SAVE_COUNT = struct.Struct('<I')
+SAVE_STRING = struct.Struct('<H')  #length, followed by the bytes
+SAVE_GAME = struct.Struct('<HHiiqi')  #game state, dungeon level, player index, stairs index, seed, spawn budget
+SAVE_MAP = struct.Struct('<HHI')  #width, height, bytes per packed layer
+SAVE_TARGET = struct.Struct('<Ii')  #targeted tile index, index of the object targeting it
+SAVE_OBJECT = struct.Struct('<hhBBBBHBH')  #x, y, char, r, g, b, name, flags, player level
+SAVE_FIGHTER = struct.Struct('<iiiiiB')  #base max hp, hp, base defense, base power, xp, death function, followed by the worn equipment
+SAVE_WORN = struct.Struct('<i')  #index of worn equipment in the inventory, or -1 followed by the equipment
+SAVE_ITEM = struct.Struct('<B')  #use function
+SAVE_EQUIPMENT = struct.Struct('<HBhhh')  #slot, is equipped, power, defense and max hp bonus
+SAVE_AI_TYPE = struct.Struct('<B')
+SAVE_BASIC_AI = struct.Struct('<hhhhh')  #speed, counter, sight radius, last seen x and y (-1 if none)
+SAVE_GATEWAY_AI = struct.Struct('<Hhhhh')  #spawned object, speed, counter, spawn range, max spawns, followed by the spawns
+SAVE_SPAWN = struct.Struct('<i')  #index of a spawn in the objects, or -1 followed by the dead spawn
+SAVE_KING_AI = struct.Struct('<hhBBBh')  #speed, counter, enraged, attack type, has a sub AI, sight radius, followed by the aimed tiles
+SAVE_RANGED_AI = struct.Struct('<hhhBhh')  #speed, counter, shoot range, has a target tile, target x, target y
+SAVE_POINT = struct.Struct('<hh')
+SAVE_NOISE = struct.Struct('<hhh')  #x, y, loudness, followed by the frontier and the tiles it reached
+SAVE_NOISE_TILE = struct.Struct('<Ih')  #tile index, how much further the sound carries from it
+SAVE_INDEX = struct.Struct('<I')
+SAVE_EFFECT = struct.Struct('<iHI')  #index of the affected object, kind, expiry tick
+SAVE_PROJECTILE = struct.Struct('<ihhhhh')  #index of the shooter (-1 if none), x, y, target x, target y, tiles flown
+SAVE_MESSAGE = struct.Struct('<HBBB')  #line, r, g, b
+SAVE_RNG = struct.Struct('<HBB')  #stream name, state version, has a gauss_next
+SAVE_RNG_STATE = struct.Struct('<625I')
+SAVE_GAUSS = struct.Struct('<d')
+
+#flags of an object record
+OBJECT_BLOCKS = 1
+OBJECT_ALWAYS_VISIBLE = 2
+OBJECT_FIGHTER = 4
+OBJECT_AI = 8
+OBJECT_ITEM = 16
+OBJECT_EQUIPMENT = 32
+OBJECT_LEVEL = 64
+OBJECT_ASLEEP = 128
+
+#functions and AI classes are saved as their index in these lists
+SAVE_DEATH_FUNCTIONS = [None, player_death, monster_death, gateway_death, boss_death, spawn_death]
+SAVE_USE_FUNCTIONS = [None, cast_heal, cast_lightning, cast_confuse, cast_fireball]
+SAVE_AI_CLASSES = [BasicMonster, GatewayAI, GoblinKingAI, RangedAI]
+
+def pack_layer(layer):
+    #pack a layer of 0/1 bytes into 8 tiles per byte, the first of each 8 tiles in the lowest bit
+    packed = bytearray((len(layer) + 7) // 8)
+    for i in range(len(layer)):
+        if layer[i]:
+            packed[i // 8] |= 1 << (i % 8)
+    return bytes(packed)
+
+def unpack_layer(packed, length):
+    packed = bytearray(packed)
+    layer = bytearray(length)
+    for i in range(length):
+        layer[i] = (packed[i // 8] >> (i % 8)) & 1
+    return layer
+
+
+class SaveWriter:
+    #builds a savegame in memory. strings are collected into a table while the records
+    #are written, and the table is put in front of them in data()
+    def __init__(self):
+        self.chunks = []
+        self.strings = []
+        self.string_ids = {}
+        self.object_ids = {}  #id of each object on the level -> its index in the objects list
+        self.inventory_ids = {}  #id of each object in the inventory -> its index there
+
+    def pack(self, record, *values):
+        self.chunks.append(record.pack(*values))
+
+    def string(self, text):
+        #returns the string's index in the string table
+        index = self.string_ids.get(text)
+        if index is None:
+            index = self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return index
+
+    def data(self):
+        table = [SAVE_COUNT.pack(len(self.strings))]
+        for text in self.strings:
+            table.append(SAVE_STRING.pack(len(text)))
+            table.append(text)
+        return SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION) + b''.join(table) + b''.join(self.chunks)
+
+    def object(self, obj):
+        flags = 0
+        if obj.blocks: flags |= OBJECT_BLOCKS
+        if obj.always_visible: flags |= OBJECT_ALWAYS_VISIBLE
+        if obj.fighter: flags |= OBJECT_FIGHTER
+        if obj.ai: flags |= OBJECT_AI
+        if obj.item: flags |= OBJECT_ITEM
+        if obj.equipment: flags |= OBJECT_EQUIPMENT
+        if hasattr(obj, 'level'): flags |= OBJECT_LEVEL
+        if wake_zones.is_asleep(obj): flags |= OBJECT_ASLEEP
+        self.pack(SAVE_OBJECT, obj.x, obj.y, ord(obj.char), obj.color.r, obj.color.g, obj.color.b,
+                  self.string(obj.name), flags, getattr(obj, 'level', 0))
+
+        if obj.fighter:
+            fighter = obj.fighter
+            self.pack(SAVE_FIGHTER, fighter.base_max_hp, fighter.hp, fighter.base_defense, fighter.base_power,
+                      fighter.xp, SAVE_DEATH_FUNCTIONS.index(fighter.death_function))
+            self.pack(SAVE_COUNT, len(fighter.equipped))
+            for slot in sorted(fighter.equipped):
+                item = fighter.equipped[slot].owner
+                index = self.inventory_ids.get(id(item), -1)
+                self.pack(SAVE_WORN, index)
+                if index == -1:  #a monster's, only it has it
+                    self.object(item)
+        if obj.ai:
+            self.ai(obj.ai)
+        if obj.equipment:
+            equipment = obj.equipment
+            self.pack(SAVE_EQUIPMENT, self.string(equipment.slot), equipment.is_equipped,
+                      equipment.power_bonus, equipment.defense_bonus, equipment.max_hp_bonus)
+        elif obj.item:
+            self.pack(SAVE_ITEM, SAVE_USE_FUNCTIONS.index(obj.item.use_function))
+
+    def ai(self, ai):
+        self.pack(SAVE_AI_TYPE, SAVE_AI_CLASSES.index(ai.__class__))
+        if isinstance(ai, BasicMonster):
+            (seen_x, seen_y) = ai.last_seen or (-1, -1)
+            self.pack(SAVE_BASIC_AI, ai.speed, ai.counter, ai.sight_radius, seen_x, seen_y)
+        elif isinstance(ai, GatewayAI):
+            self.pack(SAVE_GATEWAY_AI, self.string(ai.obj), ai.speed, ai.counter, ai.spawn_range, ai.max_spawns)
+            self.pack(SAVE_COUNT, len(ai.spawned))
+            for spawn in ai.spawned:
+                index = self.object_ids.get(id(spawn), -1)
+                self.pack(SAVE_SPAWN, index)
+                if index == -1:  #it's dead, and only the gateway has it
+                    self.object(spawn)
+        elif isinstance(ai, GoblinKingAI):
+            self.pack(SAVE_KING_AI, ai.speed, ai.counter, ai.enraged, ai.attack_type, ai.sub_ai is not None, ai.sight_radius)
+            self.points(ai.telegraph.points())
+            if ai.sub_ai is not None:
+                self.ai(ai.sub_ai)
+        elif isinstance(ai, RangedAI):
+            self.pack(SAVE_RANGED_AI, ai.speed, ai.counter, ai.shoot_range, ai.target_tile is not None,
+                      ai.target_x, ai.target_y)
+
+    def points(self, points):
+        self.pack(SAVE_COUNT, len(points))
+        for (x, y) in points:
+            self.pack(SAVE_POINT, x, y)
+
+
+class SaveReader:
+    #reads a savegame written by SaveWriter, record by record
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        (magic, version) = self.unpack(SAVE_HEADER)
+        if magic != SAVE_MAGIC:
+            raise ValueError('Not a savegame.')
+        if version != SAVE_VERSION:
+            raise ValueError('Unsupported savegame version ' + str(version) + '.')
+
+        self.sleepers = []  #objects that were saved asleep, see WakeZones
+        self.spawn_links = []  #(list, position, object index) of the gateways' spawns on the level
+        self.worn_links = []  #(fighter, inventory index) of the equipment the player wears
+        self.strings = []
+        for i in range(self.count()):
+            (length,) = self.unpack(SAVE_STRING)
+            self.strings.append(self.data[self.offset:self.offset + length])
+            self.offset += length
+
+    def unpack(self, record):
+        values = record.unpack_from(self.data, self.offset)
+        self.offset += record.size
+        return values
+
+    def count(self):
+        return self.unpack(SAVE_COUNT)[0]
+
+    def raw(self, length):
+        data = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return data
+
+    def object(self):
+        (x, y, char, r, g, b, name, flags, level) = self.unpack(SAVE_OBJECT)
+
+        fighter = None
+        if flags & OBJECT_FIGHTER:
+            (base_max_hp, hp, base_defense, base_power, xp, death_function) = self.unpack(SAVE_FIGHTER)
+            fighter = Fighter(base_max_hp, base_defense, base_power, xp, SAVE_DEATH_FUNCTIONS[death_function])
+            fighter.hp = hp
+            for i in range(self.count()):
+                (index,) = self.unpack(SAVE_WORN)
+                if index == -1:
+                    equipment = self.object().equipment
+                    fighter.equipped[equipment.slot] = equipment
+                else:  #filled in by link_worn() once the inventory is read
+                    self.worn_links.append((fighter, index))
+        ai = None
+        if flags & OBJECT_AI:
+            ai = self.ai()
+        item = None
+        equipment = None
+        if flags & OBJECT_EQUIPMENT:
+            (slot, is_equipped, power_bonus, defense_bonus, max_hp_bonus) = self.unpack(SAVE_EQUIPMENT)
+            equipment = Equipment(self.strings[slot], power_bonus, defense_bonus, max_hp_bonus)
+            equipment.is_equipped = bool(is_equipped)
+        elif flags & OBJECT_ITEM:
+            item = Item(SAVE_USE_FUNCTIONS[self.unpack(SAVE_ITEM)[0]])
+
+        obj = Object(x, y, chr(char), self.strings[name], libtcod.Color(r, g, b), blocks=bool(flags & OBJECT_BLOCKS),
+                     always_visible=bool(flags & OBJECT_ALWAYS_VISIBLE), fighter=fighter, ai=ai, item=item, equipment=equipment)
+        if flags & OBJECT_LEVEL:
+            obj.level = level
+        if fighter:
+            for equipment in fighter.equipped.values():
+                equipment.wearer = obj
+        if flags & OBJECT_ASLEEP:
+            self.sleepers.append(obj)
+
+        #the sub AI of an AI belongs to the same object
+        while ai is not None:
+            ai.owner = obj
+            ai = getattr(ai, 'sub_ai', None)
+        return obj
+
+    def ai(self):
+        ai_class = SAVE_AI_CLASSES[self.unpack(SAVE_AI_TYPE)[0]]
+        if ai_class is BasicMonster:
+            (speed, counter, sight_radius, seen_x, seen_y) = self.unpack(SAVE_BASIC_AI)
+            ai = BasicMonster(speed, sight_radius)
+            if seen_x != -1:
+                ai.last_seen = (seen_x, seen_y)
+        elif ai_class is GatewayAI:
+            (obj, speed, counter, spawn_range, max_spawns) = self.unpack(SAVE_GATEWAY_AI)
+            ai = GatewayAI(self.strings[obj], speed, spawn_range, max_spawns)
+            for i in range(self.count()):
+                (index,) = self.unpack(SAVE_SPAWN)
+                if index == -1:
+                    ai.spawned.append(self.object())
+                else:  #filled in by link_spawns() once all the objects are read
+                    self.spawn_links.append((ai.spawned, len(ai.spawned), index))
+                    ai.spawned.append(None)
+        elif ai_class is GoblinKingAI:
+            (speed, counter, enraged, attack_type, has_sub_ai, sight_radius) = self.unpack(SAVE_KING_AI)
+            ai = GoblinKingAI(speed, sight_radius=sight_radius)
+            ai.enraged = bool(enraged)
+            ai.attack_type = attack_type
+            ai.telegraph.cells = set(x + y * MAP_WIDTH for (x, y) in self.points())  #the map has them targeted already
+            if has_sub_ai:
+                ai.sub_ai = self.ai()
+        elif ai_class is RangedAI:
+            (speed, counter, shoot_range, has_target_tile, target_x, target_y) = self.unpack(SAVE_RANGED_AI)
+            ai = RangedAI(speed, shoot_range)
+            (ai.target_x, ai.target_y) = (target_x, target_y)
+            if has_target_tile:
+                ai.target_tile = map[target_x][target_y]
+        ai.counter = counter
+        return ai
+
+    def points(self):
+        return [self.unpack(SAVE_POINT) for i in range(self.count())]
+
+    def link_spawns(self, objects):
+        for (spawned, position, index) in self.spawn_links:
+            spawned[position] = objects[index]
+
+    def link_worn(self, inventory):
+        for (fighter, index) in self.worn_links:
+            equipment = inventory[index].equipment
+            fighter.equipped[equipment.slot] = equipment
+            equipment.wearer = fighter.owner
+
+
 def save_game():
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    file['player_index'] = objects.index(player)  #index of player in objects list
-    file['inventory'] = inventory
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
+    scheduler.sync_all()  #the AI counters are saved as they'd be without the scheduler
+    save = SaveWriter()
+
+    #the map, as bit-packed layers, and who is targeting which tile
+    layer_size = (len(map.blocked) + 7) // 8
+    save.pack(SAVE_MAP, map.width, map.height, layer_size)
+    for layer in (map.blocked, map.block_sight, map.explored, map.targeted):
+        save.chunks.append(pack_layer(layer))
+    save.chunks.append(bytes(wake_zones.room_of))  #a byte per tile, room numbers don't fit in bits
+    object_ids = save.object_ids = dict((id(obj), index) for (index, obj) in enumerate(objects))
+    save.inventory_ids = dict((id(obj), index) for (index, obj) in enumerate(inventory))
+    targets = [(i, object_ids.get(id(shooter), -1)) for (i, shooters) in sorted(map.targeted_by.items()) for shooter in shooters]
+    save.pack(SAVE_COUNT, len(targets))
+    for (i, shooter) in targets:
+        save.pack(SAVE_TARGET, i, shooter)
+    save.pack(SAVE_COUNT, len(projectiles.flying))
+    for arrow in projectiles.flying:
+        save.pack(SAVE_PROJECTILE, object_ids.get(id(arrow.shooter), -1), arrow.x, arrow.y,
+                  arrow.target_x, arrow.target_y, arrow.flown)
+    save.pack(SAVE_COUNT, len(noise.sounds))
+    for sound in noise.sounds:
+        save.pack(SAVE_NOISE, sound.x, sound.y, sound.loudness)
+        save.pack(SAVE_COUNT, len(sound.frontier))
+        for (i, loudness) in sound.frontier:
+            save.pack(SAVE_NOISE_TILE, i, loudness)
+        save.pack(SAVE_COUNT, len(sound.heard))
+        for i in sorted(sound.heard):
+            save.pack(SAVE_INDEX, i)
+
+    #the objects on the map and in the inventory
+    for obj_list in (objects, inventory):
+        save.pack(SAVE_COUNT, len(obj_list))
+        for obj in obj_list:
+            save.object(obj)
+
+    #the status effects, on objects on the map
+    effects = [(object_ids[id(obj)], kind, expiry) for (expiry, order, obj, kind) in status.entries() if id(obj) in object_ids]
+    save.pack(SAVE_INDEX, status.tick)
+    save.pack(SAVE_COUNT, len(effects))
+    for (index, kind, expiry) in effects:
+        save.pack(SAVE_EFFECT, index, save.string(kind), expiry)
+
+    save.pack(SAVE_COUNT, len(game_msgs))
+    for (line, color) in game_msgs:
+        save.pack(SAVE_MESSAGE, save.string(line), color.r, color.g, color.b)
+
+    #the random number streams, so the game goes on exactly as it would have
+    save.pack(SAVE_COUNT, len(rng.streams))
+    for (name, stream) in sorted(rng.streams.items()):
+        (version, state, gauss_next) = stream.getstate()
+        save.pack(SAVE_RNG, save.string(name), version, gauss_next is not None)
+        save.pack(SAVE_RNG_STATE, *state)
+        if gauss_next is not None:
+            save.pack(SAVE_GAUSS, gauss_next)
+
     try:
-        file['stairs_index'] = objects.index(stairs)
+        stairs_index = objects.index(stairs)
     except:
-        file['stairs_index'] = -1
-    file['dungeon_level'] = dungeon_level
+        stairs_index = -1
+    save.pack(SAVE_GAME, save.string(game_state), dungeon_level, objects.index(player), stairs_index, rng.seed, spawn_budget)
+
+    file = open(SAVE_FILE, 'wb')
+    file.write(save.data())
     file.close()
 
 def load_game():
-    #open the previously saved shelve and load the game data
-    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level
-
-    file = shelve.open('savegame', 'r')
-    map = file['map']
-    objects = file['objects']
-    player = objects[file['player_index']]  #get index of player in objects list and access it
-    inventory = file['inventory']
-    game_msgs = file['game_msgs']
-    game_state = file['game_state']
-    if file['stairs_index'] != -1:
-        stairs = objects[file['stairs_index']]
-    dungeon_level = file['dungeon_level']
+    #open the previously saved game and load the game data
+    global map, objects, spawn_budget, status, player, inventory, game_msgs, game_state, stairs, dungeon_level, rng
+
+    file = open(SAVE_FILE, 'rb')
+    save = SaveReader(file.read())
     file.close()
 
+    (width, height, layer_size) = save.unpack(SAVE_MAP)
+    map = TileGrid(width, height)
+    map.blocked = unpack_layer(save.raw(layer_size), width * height)
+    map.block_sight = unpack_layer(save.raw(layer_size), width * height)
+    map.explored = unpack_layer(save.raw(layer_size), width * height)
+    map.targeted = unpack_layer(save.raw(layer_size), width * height)
+    room_of = save.raw(width * height)
+    targets = [save.unpack(SAVE_TARGET) for i in range(save.count())]
+    arrows = [save.unpack(SAVE_PROJECTILE) for i in range(save.count())]
+    sounds = []
+    for i in range(save.count()):
+        sound = Noise(*save.unpack(SAVE_NOISE))
+        sound.frontier = collections.deque(save.unpack(SAVE_NOISE_TILE) for j in range(save.count()))
+        sound.heard = set(save.unpack(SAVE_INDEX)[0] for j in range(save.count()))
+        sounds.append(sound)
+
+    objects = [save.object() for i in range(save.count())]
+    inventory = [save.object() for i in range(save.count())]
+    save.link_spawns(objects)
+    save.link_worn(inventory)
+    status = StatusEffects()
+    status.tick = save.unpack(SAVE_INDEX)[0]
+    for i in range(save.count()):
+        (index, kind, expiry) = save.unpack(SAVE_EFFECT)
+        status.apply(objects[index], save.strings[kind], expiry - status.tick)
+    for (i, shooter) in targets:
+        map.targeted_by.setdefault(i, []).append(objects[shooter] if shooter != -1 else None)
+
+    game_msgs = []
+    for i in range(save.count()):
+        (line, r, g, b) = save.unpack(SAVE_MESSAGE)
+        game_msgs.append((save.strings[line], libtcod.Color(r, g, b)))
+
+    streams = {}
+    for i in range(save.count()):
+        (name, version, has_gauss) = save.unpack(SAVE_RNG)
+        state = save.unpack(SAVE_RNG_STATE)
+        gauss_next = save.unpack(SAVE_GAUSS)[0] if has_gauss else None
+        streams[save.strings[name]] = (version, state, gauss_next)
+
+    (state, dungeon_level, player_index, stairs_index, seed, budget) = save.unpack(SAVE_GAME)
+    game_state = save.strings[state]
+    player = objects[player_index]  #get index of player in objects list and access it
+    if stairs_index != -1:
+        stairs = objects[stairs_index]
+    rng = RandomStreams(seed)
+    for (name, state) in streams.items():
+        rng.streams[name].setstate(state)
+
+    #the occupancy index, level stats, turn scheduler and wake zones aren't saved, rebuild them from the map and objects
+    reset_level_state(objects, rebuild=True, room_of=room_of, sleepers=save.sleepers)
+    spawn_budget = budget
+    projectiles.flying = [Projectile(objects[shooter] if shooter != -1 else None, x, y, target_x, target_y, flown)
+                          for (shooter, x, y, target_x, target_y, flown) in arrows]
+    noise.sounds = sounds
+
     initialize_fov()
+    start_pregeneration()
+
+
+#############################################
+# Headless Simulation
+#############################################
+
+def init_headless():
+    #run the game logic without a window: no font, no consoles and no rendering.
+    #FOV still goes through libtcod's map functions, which don't need a window
+    global headless, pregenerate_levels, con, panel, key, mouse
+    headless = True
+    pregenerate_levels = False  #soak tests drive next_level directly, set this back to test pregeneration
+    con = None
+    panel = None
+    key = libtcod.Key()
+    mouse = libtcod.Mouse()
+
+def simulate_turn(dx=0, dy=0):
+    #one pass of play_game without rendering: the player moves or attacks by (dx, dy)
+    #(or waits, if both are 0), then the monsters take their turn. returns the game state
+    if fov_recompute:
+        compute_fov()
+
+    if game_state == 'playing':
+        if dx != 0 or dy != 0:
+            player_move_or_attack(dx, dy)
+        monsters_take_turn()
+
+    if fov_recompute:
+        compute_fov()
+    return game_state
+
+def simulate_descend():
+    #take the stairs if the player is on them, returns True if a new level was made
+    if stairs.x == player.x and stairs.y == player.y:
+        next_level()
+        compute_fov()
+        return True
+    return False
 
 
 #############################################
 # Initialization & Main Loop
 #############################################
 
-libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'R U N N E R', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+def init_console():
+    global con, panel
+    libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'R U N N E R', False)
+    libtcod.sys_set_fps(LIMIT_FPS)
+    con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
 
 
-main_menu()
+if __name__ == '__main__':
+    init_console()
+    main_menu()
@@ -0,0 +1,311 @@
+#benchmarks for the game logic and rendering. runs without a display:
+#
+#   python benchmark.py [--seed N] [--repeat N] [--output results.json] [--no-render]
+#
+#every case is timed --repeat times and reported as mean, p50 and p99 in milliseconds.
+#the results are also written as JSON, so runs can be compared across changes.
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+from timeit import default_timer as timer
+
+#let SDL run without a display, for the render benchmark
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import Runner
+
+MONSTER_COUNTS = [10, 100, 1000]
+IS_BLOCKED_BATCH = 1000
+STAT_READS_BATCH = 1000
+
+
+def percentile(sorted_times, fraction):
+    #nearest-rank percentile of an already sorted list
+    index = int(round(fraction * (len(sorted_times) - 1)))
+    return sorted_times[index]
+
+def summarize(name, times, **params):
+    times = sorted(times)
+    result = {'name': name, 'runs': len(times),
+              'mean_ms': 1000.0 * sum(times) / len(times),
+              'p50_ms': 1000.0 * percentile(times, 0.5),
+              'p99_ms': 1000.0 * percentile(times, 0.99)}
+    result.update(params)
+    return result
+
+def time_case(function, repeat, setup=None):
+    #time function() repeat times, calling setup() (untimed) before each run
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = timer()
+        function()
+        times.append(timer() - start)
+    return times
+
+
+def start_level(level):
+    Runner.dungeon_level = level
+    Runner.rng.start_level(level)
+
+def make_level(level):
+    start_level(level)
+    if level != 10:
+        Runner.make_map()
+    else:
+        Runner.make_boss_map()
+
+def spawn_monsters(name, count):
+    #fill the current level with count monsters on free tiles, returns how many fit
+    free = [(x, y) for y in range(Runner.MAP_HEIGHT) for x in range(Runner.MAP_WIDTH)
+            if not Runner.is_blocked(x, y)]
+    Runner.rng.streams['spawn'].shuffle(free)
+    for (x, y) in free[:count]:
+        Runner.ObjectFactory.create_object(name, x, y)
+    return min(count, len(free))
+
+def make_crowded_level(count, asleep=False, name='goblin'):
+    #a level 1 map with count extra goblins (or other monsters), and a player that can't die.
+    #with asleep, the monsters in rooms sleep like the ones make_map places, until the player comes by
+    make_level(1)
+    spawned = spawn_monsters(name, count)
+    if asleep:
+        zones = Runner.wake_zones
+        for obj in Runner.objects:
+            if obj.ai and zones.room_of[obj.x + obj.y * Runner.MAP_WIDTH] and not zones.is_asleep(obj):
+                zones.sleep(obj)
+        zones.player_moved(Runner.player.x, Runner.player.y)
+    Runner.player.fighter.base_max_hp = Runner.player.fighter.hp = 10 ** 9
+    Runner.initialize_fov()
+    Runner.compute_fov()
+    return spawned
+
+
+def bench_mapgen(repeat):
+    results = []
+    for level in range(1, 10):
+        times = time_case(Runner.make_map, repeat, setup=lambda: start_level(level))
+        results.append(summarize('make_map', times, level=level))
+    times = time_case(Runner.make_boss_map, repeat, setup=lambda: start_level(10))
+    results.append(summarize('make_boss_map', times, level=10))
+    return results
+
+def bench_fov(repeat):
+    make_level(1)
+    return [summarize('initialize_fov', time_case(Runner.initialize_fov, repeat)),
+            summarize('compute_fov', time_case(Runner.compute_fov, repeat))]
+
+def bench_render(repeat):
+    Runner.init_console()
+    make_level(1)
+    #a full frame has every tile to draw, an idle one has nothing that changed
+    full = summarize('render_all_full', time_case(Runner.render_all, repeat, setup=Runner.initialize_fov))
+    idle = summarize('render_all_idle', time_case(Runner.render_all, repeat))
+
+    def step():
+        Runner.player_move_or_attack(step.dx, 0)
+        step.dx = -step.dx
+    step.dx = 1
+    moved = summarize('render_all_step', time_case(Runner.render_all, repeat, setup=step))
+    Runner.init_headless()
+    return [full, idle, moved]
+
+def bench_monsters(repeat):
+    results = []
+    for count in MONSTER_COUNTS:
+        spawned = make_crowded_level(count)
+        times = time_case(Runner.monsters_take_turn, repeat)
+        results.append(summarize('monster_turn_sweep', times, monsters=spawned))
+    for count in MONSTER_COUNTS:
+        spawned = make_crowded_level(count, asleep=True)
+        times = time_case(Runner.monsters_take_turn, repeat)
+        results.append(summarize('monster_turn_dormant', times, monsters=spawned,
+                                 asleep=len(Runner.wake_zones.asleep)))
+    return results
+
+def bench_hunt(repeat):
+    #every monster heads for where it last saw the player, along its cached A* path
+    results = []
+    for count in MONSTER_COUNTS:
+        spawned = make_crowded_level(count)
+        for obj in Runner.objects:
+            if isinstance(obj.ai, Runner.BasicMonster):
+                obj.ai.last_seen = (Runner.player.x, Runner.player.y)
+        Runner.path_computations = Runner.path_reuses = 0
+        times = time_case(Runner.monsters_take_turn, repeat)
+        results.append(summarize('monster_hunt', times, monsters=spawned,
+                                 path_hit_rate=round(Runner.path_cache_hit_rate(), 3)))
+    return results
+
+def bench_confused(repeat):
+    #every monster confused, stumbling around instead of acting until its confusion runs out
+    results = []
+    for count in MONSTER_COUNTS:
+        spawned = make_crowded_level(count)
+        Runner.status = Runner.StatusEffects()
+        for obj in Runner.objects:
+            if obj.ai:
+                Runner.status.apply(obj, 'confused', 10 * repeat)
+        times = time_case(Runner.monsters_take_turn, repeat)
+        results.append(summarize('confused_turn', times, monsters=spawned, effects=len(Runner.status.heap)))
+    return results
+
+def bench_ranged(repeat):
+    #archers only aim at the player when they can see them, and shoot arrows that fly over several ticks
+    results = []
+    for count in MONSTER_COUNTS:
+        spawned = make_crowded_level(count, name='archer')
+        Runner.sight_traces = Runner.sight_reuses = 0
+        times = time_case(Runner.monsters_take_turn, repeat)
+        results.append(summarize('ranged_turn', times, monsters=spawned,
+                                 sight_hit_rate=round(Runner.sight_cache_hit_rate(), 3)))
+    return results
+
+def bench_noise(repeat):
+    #one tick of a fireball's noise spreading over a crowded level, and waking the monsters that hear it
+    results = []
+    for count in MONSTER_COUNTS:
+        spawned = make_crowded_level(count)
+
+        def emit():
+            Runner.noise = Runner.NoiseField()
+            Runner.noise.emit(Runner.player.x, Runner.player.y, Runner.NOISE_FIREBALL)
+        times = time_case(lambda: Runner.noise.run_tick(), repeat, setup=emit)
+        results.append(summarize('noise_tick', times, monsters=spawned, budget=Runner.NOISE_BUDGET))
+    return results
+
+def bench_area_query(repeat):
+    #what a fireball hits and what lightning strikes, around the player on a crowded level
+    results = []
+    for count in MONSTER_COUNTS:
+        spawned = make_crowded_level(count)
+        (x, y) = (Runner.player.x, Runner.player.y)
+
+        def query():
+            Runner.fighters_in_area(x, y, Runner.disc_offsets(Runner.FIREBALL_RADIUS))
+            Runner.closest_monster(Runner.LIGHTNING_RANGE)
+        times = time_case(query, repeat)
+        results.append(summarize('area_query', times, monsters=spawned, radius=Runner.FIREBALL_RADIUS))
+    return results
+
+def bench_spawn(repeat):
+    #the object prototypes made from the data file and from its cache, and a crowd of goblins made from them
+    results = [summarize('load_prototypes', time_case(lambda: Runner.ObjectFactory.load(Runner.read_entities()), repeat),
+                         cached=False),
+               summarize('load_prototypes', time_case(lambda: Runner.ObjectFactory.load(Runner.load_entities()), repeat),
+                         cached=True)]
+    cells = []
+
+    def setup():
+        make_level(1)
+        free = [(x, y) for y in range(Runner.MAP_HEIGHT) for x in range(Runner.MAP_WIDTH)
+                if not Runner.is_blocked(x, y)]
+        Runner.rng.streams['spawn'].shuffle(free)
+        cells[:] = free[:MONSTER_COUNTS[-1]]
+
+    def spawn():
+        for (x, y) in cells:
+            Runner.ObjectFactory.create_object('goblin', x, y)
+    times = time_case(spawn, repeat, setup=setup)
+    results.append(summarize('create_object', times, objects=len(cells)))
+    return results
+
+def bench_is_blocked(repeat):
+    spawned = make_crowded_level(MONSTER_COUNTS[-1])
+    stream = Runner.rng.streams['ai']
+    cells = [(stream.randint(0, Runner.MAP_WIDTH - 1), stream.randint(0, Runner.MAP_HEIGHT - 1))
+             for i in range(IS_BLOCKED_BATCH)]
+    is_blocked = Runner.is_blocked
+
+    def batch():
+        for (x, y) in cells:
+            is_blocked(x, y)
+    times = time_case(batch, repeat)
+    return [summarize('is_blocked', times, monsters=spawned, calls=IS_BLOCKED_BATCH)]
+
+def bench_fighter_stats(repeat):
+    #the player's max hp, defense and power read over and over, with a full inventory to sum the bonuses from
+    make_level(1)
+    del Runner.inventory[:]
+    for i in range(Runner.MAX_INVENTORY):
+        name = ['petty-sword', 'petty-shield', 'petty-breastplate', 'heal'][i % 4]
+        Runner.ObjectFactory.create_object(name, Runner.player.x, Runner.player.y)
+        Runner.occupancy.items_at(Runner.player.x, Runner.player.y)[0].item.pick_up()
+    fighter = Runner.player.fighter
+
+    def batch():
+        for i in range(STAT_READS_BATCH):
+            fighter.max_hp
+            fighter.defense
+            fighter.power
+    times = time_case(batch, repeat)
+    return [summarize('fighter_stats', times, inventory=len(Runner.inventory), reads=3 * STAT_READS_BATCH)]
+
+def bench_save_load(repeat):
+    #save_game and load_game use the working directory, so run them in a scratch one
+    make_level(1)
+    Runner.initialize_fov()
+    Runner.compute_fov()
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp()
+    os.chdir(scratch)
+    try:
+        save_times = time_case(Runner.save_game, repeat)
+        load_times = time_case(Runner.load_game, repeat)
+        size = sum(os.path.getsize(name) for name in os.listdir('.') if name.startswith('savegame'))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+    return [summarize('save_game', save_times, bytes=size),
+            summarize('load_game', load_times, bytes=size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runner benchmarks')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--no-render', action='store_true', help='skip the render_all benchmark')
+    args = parser.parse_args()
+
+    Runner.init_headless()
+    Runner.new_game(args.seed)
+
+    results = []
+    results += bench_mapgen(args.repeat)
+    results += bench_fov(args.repeat)
+    if not args.no_render:
+        results += bench_render(args.repeat)
+    results += bench_monsters(args.repeat)
+    results += bench_hunt(args.repeat)
+    results += bench_confused(args.repeat)
+    results += bench_ranged(args.repeat)
+    results += bench_noise(args.repeat)
+    results += bench_area_query(args.repeat)
+    results += bench_spawn(args.repeat)
+    results += bench_is_blocked(args.repeat)
+    results += bench_fighter_stats(args.repeat)
+    results += bench_save_load(args.repeat)
+
+    for result in results:
+        params = ', '.join('%s=%s' % (key, result[key]) for key in sorted(result)
+                           if key not in ('name', 'runs', 'mean_ms', 'p50_ms', 'p99_ms'))
+        print('%-20s %-30s mean %9.3f ms   p50 %9.3f ms   p99 %9.3f ms' % (
+            result['name'], params, result['mean_ms'], result['p50_ms'], result['p99_ms']))
+
+    report = {'seed': args.seed, 'repeat': args.repeat, 'time': time.time(),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print('results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()